@@ -1,14 +1,32 @@
 import os
 import time
 import math
-import traceback
+import errno
 import pathlib
 import argparse
 import sys
 import pprint
 import textwrap
 import mimetypes
+import json
+import threading
+import concurrent.futures
+import array
+import operator
+import collections.abc
+import sqlite3
+import csv
+import heapq
+import functools
+import itertools
+import contextlib
+import collections
+import asyncio
+import mmap
+import fnmatch
+import re
 
+@functools.lru_cache(maxsize=65536)
 def human_readable_size(size_bytes):
    if size_bytes == 0:
        return "0B"
@@ -107,330 +125,1871 @@ source_code_extensions = [
 excecutable_extensions = [
     ".exe", ".dll", ".so", ".bin", ".app", ".dmg", ".elf", ".o", ".obj", ".class", ".jar", ".pyc", ".pyd", ".wasm"
 ]
-class DirectorySizeCalculator:
+
+# Типы файлов в порядке приоритета: расширение относится к первому типу, в списке которого оно есть
+file_types = [
+    ('video', ['.mp4', '.webm', '.avi', '.mkv', '.mov', '.ogg', '.wmv']),
+    ('image', ['.jpg', '.jpeg', '.png', '.bmp', '.gif', '.webp', '.tiff', '.tif']),
+    ('doc', ['.txt', '.odt', '.ods', '.odp', '.html', 
+             '.css', '.pdf', '.mhtml', '.xml', '.json', '.docx', '.djvu', '.djv',
+             '.xls', '.xlsx', '.ppt', '.pptx', '.xml', '.md', '.markdown', '.yaml', '.yml']),
+    ('source code', source_code_extensions),
+    ('executable', excecutable_extensions),
+    ('disk image', ['.iso', '.img']),
+    ('virtual machine image', ['.vhd', '.vhdx', '.vmdk']),
+    ('database', ['.db', '.mdb', '.sqlite', '.sql']),
+    ('audio', ['.mp3', '.flac', '.m4a', '.wav', '.ogg']),
+    ('sub', ['.srt', '.ass', '.vtt']),
+    ('archive', ['.zip', '.rar', '.gzip', '.gz', '.tar', '.7z']),
+]
+
+# Функция для построения таблицы "расширение -> тип файла"
+# Пользовательские категории имеют приоритет над встроенными
+def build_file_type_table(categories = None):
+    table = {}
+    if categories:
+        for file_type, extensions in categories.items():
+            for extension in extensions:
+                table.setdefault(extension.lower(), file_type)
+    for file_type, extensions in file_types:
+        for extension in extensions:
+            table.setdefault(extension, file_type)
+    return table
+
+# Функция для загрузки пользовательских категорий из JSON-файла вида {"тип": [".ext1", ".ext2"]}
+def load_file_categories(path):
+    with open(path, encoding='utf-8') as config_file:
+        categories = json.load(config_file)
+    if not isinstance(categories, dict):
+        raise ValueError('%s: ожидается объект {"тип": [".ext", ...]}' % path)
+    for file_type, extensions in categories.items():
+        if not isinstance(extensions, list):
+            raise ValueError('%s: для типа "%s" ожидается список расширений [".ext", ...]' % (path, file_type))
+        for extension in extensions:
+            if not isinstance(extension, str) or not extension.startswith('.'):
+                raise ValueError('%s: для типа "%s" расширение %s должно быть строкой, начинающейся с "."' % (path, file_type, json.dumps(extension, ensure_ascii=False)))
+    return categories
+
+file_type_table = build_file_type_table()
+
+class FileClassifier:
+    def __init__(self, categories = None):
+        if categories:
+            self.file_type_table = build_file_type_table(categories)
+        else:
+            self.file_type_table = file_type_table
+        # Кэш "окончание имени файла -> (тип, расширение, mimetype)", заполняется при первой встрече окончания
+        self.classes = {}
+        self.guess_type_calls = 0 # Количество вызовов mimetypes.guess_type и затраченное на них время
+        self.guess_type_seconds = 0.0
+
+    # Метод для классификации расширения с сохранением результата в кэше
+    def _classify_suffix(self, suffix):
+        lower_suffix = suffix.lower()
+        # Расширения сжатия (.gz, .svgz и т.п.) влияют на mimetype вместе с предыдущим расширением,
+        # поэтому такие файлы классифицируются без кэша
+        if (suffix in mimetypes.encodings_map or lower_suffix in mimetypes.encodings_map
+                or suffix in mimetypes.suffix_map or lower_suffix in mimetypes.suffix_map):
+            return None
+        file_mimetype = self.guess_type('file' + suffix)
+        if file_mimetype == None:
+            file_mimetype = 'undefined'
+        file_class = (self.file_type_table.get(lower_suffix, 'undefined'), lower_suffix, file_mimetype)
+        self.classes[suffix] = file_class
+        return file_class
+
+    # Метод для определения mimetype по имени файла, вызывается только при промахе кэша
+    def guess_type(self, filepath):
+        start = time.perf_counter()
+        file_mimetype = mimetypes.guess_type(filepath)[0]
+        self.guess_type_calls += 1
+        self.guess_type_seconds += time.perf_counter() - start
+        return file_mimetype
+
+    # Метод для определения типа, расширения и mimetype файла
+    # Для файлов с обычным расширением это один поиск в словаре
+    def classify(self, filepath):
+        filename = os.path.basename(filepath)
+        i = filename.rfind('.')
+        if 0 < i < len(filename) - 1 and filename[0] != '.':
+            file_class = self.classes.get(filename[i:])
+            if file_class is None:
+                file_class = self._classify_suffix(filename[i:])
+            if file_class is not None:
+                return file_class
+        # Имена без расширения, начинающиеся с точки и сжатые файлы
+        file_suffix = pathlib.Path(filepath).suffix.lower()
+        file_mimetype = self.guess_type(filepath)
+        if file_mimetype == None:
+            file_mimetype = 'undefined'
+        return (self.file_type_table.get(file_suffix, 'undefined'), file_suffix, file_mimetype)
+
+file_classifier = FileClassifier()
+
+# Хранилище деталей по директориям: категории ('type'/'ext'/'mimetype', имя) интернируются
+# в целочисленные идентификаторы. Для каждой директории хранится разреженный вектор -
+# array('q') из пар (идентификатор категории, размер) только для ненулевых категорий.
+# Детали директории, которая ещё собирается (сканируются её файлы или добавляются поддиректории),
+# хранятся в словаре "идентификатор категории -> размер" до вызова finish
+class DirectoryDetailStore:
+    sections = ('type', 'ext', 'mimetype')
+
     def __init__(self):
+        self.categories = [] # Идентификатор категории -> (секция, имя)
+        self.category_ids = {} # (секция, имя) -> идентификатор категории
+        self.class_ids = {} # (тип, расширение, mimetype) -> (id типа, id расширения, id mimetype)
+        self.vectors = {} # Путь директории -> разреженный вектор
+        self.pending = {} # Путь директории -> словарь собираемых деталей
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    # Метод для получения идентификатора категории, новые категории добавляются в конец
+    def category_id(self, section, name):
+        key = (section, name)
+        category_id = self.category_ids.get(key)
+        if category_id is None:
+            with self._lock:
+                category_id = self.category_ids.get(key)
+                if category_id is None:
+                    category_id = len(self.categories)
+                    self.categories.append(key)
+                    self.category_ids[key] = category_id
+        return category_id
+
+    # Метод для получения идентификаторов категорий файла по результату FileClassifier.classify
+    def _class_ids(self, file_class):
+        ids = (self.category_id('type', file_class[0]),
+               self.category_id('ext', file_class[1]),
+               self.category_id('mimetype', file_class[2]))
+        self.class_ids[file_class] = ids
+        return ids
+
+    # Функция для получения пар (идентификатор категории, размер) словаря или разреженного вектора
+    @staticmethod
+    def items(vector):
+        if isinstance(vector, dict):
+            return vector.items()
+        return zip(vector[0::2], vector[1::2])
+
+    # Функция для упаковки словаря деталей в разреженный вектор, нулевые размеры отбрасываются
+    @staticmethod
+    def pack(vector):
+        return array.array('q', itertools.chain.from_iterable(item for item in vector.items() if item[1]))
+
+    # Метод для получения словаря собираемых деталей директории, разреженный вектор распаковывается
+    def _pending(self, directory):
+        vector = self.pending.get(directory)
+        if vector is None:
+            vector = dict(self.items(self.vectors.pop(directory, ())))
+            self.pending[directory] = vector
+        return vector
+
+    # Метод для завершения сбора деталей директории: словарь упаковывается в разреженный вектор
+    def finish(self, directory):
+        vector = self.pending.pop(directory, None)
+        if vector is not None:
+            packed = self.pack(vector)
+            if packed:
+                self.vectors[directory] = packed
+
+    # Метод для добавления размера файла к категориям словаря деталей vector
+    def add_to_vector(self, vector, file_class, filesize):
+        ids = self.class_ids.get(file_class)
+        if ids is None:
+            ids = self._class_ids(file_class)
+        vector[ids[0]] = vector.get(ids[0], 0) + filesize
+        vector[ids[1]] = vector.get(ids[1], 0) + filesize
+        vector[ids[2]] = vector.get(ids[2], 0) + filesize
+
+    # Метод для добавления размера файла к категориям собираемой директории
+    def add(self, directory, file_class, filesize):
+        self.add_to_vector(self._pending(directory), file_class, filesize)
+
+    # Метод для сложения словаря деталей vector с other_vector (словарём или разреженным вектором)
+    def sum_vectors(self, vector, other_vector):
+        for category_id, size in self.items(other_vector):
+            vector[category_id] = vector.get(category_id, 0) + size
+
+    # Метод для добавления other_vector к деталям директории, детали директории считаются собранными
+    def add_vector(self, directory, other_vector):
+        if directory in self.pending or directory in self.vectors:
+            self.sum_vectors(self._pending(directory), other_vector)
+            self.finish(directory)
+        elif isinstance(other_vector, dict):
+            packed = self.pack(other_vector)
+            if packed:
+                self.vectors[directory] = packed
+        elif other_vector:
+            self.vectors[directory] = array.array('q', other_vector)
+
+    # Метод для получения разреженного вектора директории
+    def get_vector(self, directory):
+        vector = self.pending.get(directory)
+        if vector is not None:
+            return self.pack(vector)
+        return self.vectors.get(directory, array.array('q'))
+
+    # Метод для добавления деталей в виде словаря {'type': {}, 'ext': {}, 'mimetype': {}} к деталям директории
+    def add_detail_sizes(self, directory, detail):
+        vector = {}
+        for section, section_sizes in detail.items():
+            for name, size in section_sizes.items():
+                vector[self.category_id(section, name)] = size
+        self.add_vector(directory, vector)
+
+    # Метод для добавления деталей поддиректории child к собираемым деталям директории directory
+    # При discard = True детали поддиректории после этого удаляются
+    def merge(self, directory, child, discard = False):
+        self.finish(child)
+        if discard:
+            child_vector = self.vectors.pop(child, None)
+        else:
+            child_vector = self.vectors.get(child)
+        if child_vector is not None:
+            self.sum_vectors(self._pending(directory), child_vector)
+
+    # Метод для добавления деталей всех директорий другого хранилища
+    # Идентификаторы категорий другого хранилища переводятся в идентификаторы этого
+    def merge_store(self, other):
+        category_ids = [self.category_id(section, name) for section, name in other.categories]
+        for directory, other_vector in other.vectors.items():
+            self.add_vector(directory, {category_ids[category_id]: size for category_id, size in self.items(other_vector)})
+
+    # Метод для преобразования словаря деталей или разреженного вектора в словарь {'type': {}, 'ext': {}, 'mimetype': {}}
+    def vector_detail(self, vector):
+        detail = {'type': {}, 'ext': {}, 'mimetype': {}}
+        categories = self.categories
+        for category_id, size in self.items(vector):
+            if size:
+                section, name = categories[category_id]
+                detail[section][name] = size
+        return detail
+
+    # Метод для получения деталей директории в виде словаря {'type': {}, 'ext': {}, 'mimetype': {}}
+    def detail(self, directory):
+        vector = self.pending.get(directory)
+        if vector is None:
+            vector = self.vectors.get(directory, ())
+        return self.vector_detail(vector)
+
+# Представление хранилища деталей в виде словаря "путь -> детали",
+# словарь деталей директории строится только при обращении к нему
+class DirectoryDetailView(collections.abc.Mapping):
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, directory):
+        if directory not in self:
+            raise KeyError(directory)
+        return self.store.detail(directory)
+
+    def __contains__(self, directory):
+        return directory in self.store.vectors or directory in self.store.pending
+
+    def __iter__(self):
+        return iter(self.store.vectors)
+
+    def __len__(self):
+        return len(self.store.vectors)
+
+# Статистика сканирования: счётчики, время по фазам и самые медленные директории.
+# При сканировании в несколько потоков время фаз суммируется по всем потокам.
+# progress(stats) вызывается не чаще одного раза в progress_interval секунд
+class ScanStats:
+    phases = ('scandir', 'stat', 'classify', 'mimetype', 'merge', 'build', 'sort', 'render')
+    counters = ('directories', 'files', 'stat_calls', 'errors', 'bytes', 'cache_hits', 'mimetype_guesses')
+
+    def __init__(self, progress = None, progress_interval = 0.5, slowest = 10):
+        for name in self.counters:
+            setattr(self, name, 0)
+        self.phase_times = dict.fromkeys(self.phases, 0.0)
+        self.slowest = slowest # Количество самых медленных директорий, которые нужно запомнить
+        self.slowest_directories = [] # Куча (время сканирования, путь)
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self.start_time = time.perf_counter()
+        self._progress_time = self.start_time
+        self._classifiers = {} # id классификатора -> [классификатор, вызовы guess_type, время guess_type] на момент подключения
+        self._lock = threading.Lock()
+
+    # Блокировка, функция progress и классификаторы не передаются между процессами
+    def __getstate__(self):
+        self.update_classifiers()
+        state = self.__dict__.copy()
+        del state['_lock']
+        state['progress'] = None
+        state['_classifiers'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    # Метод для подключения классификатора, чьи вызовы mimetypes.guess_type нужно учитывать
+    def watch_classifier(self, classifier):
+        with self._lock:
+            if id(classifier) not in self._classifiers:
+                self._classifiers[id(classifier)] = [classifier, classifier.guess_type_calls, classifier.guess_type_seconds]
+
+    # Метод для переноса новых вызовов guess_type подключённых классификаторов в статистику
+    def update_classifiers(self):
+        with self._lock:
+            for watched in self._classifiers.values():
+                classifier = watched[0]
+                self.mimetype_guesses += classifier.guess_type_calls - watched[1]
+                self.phase_times['mimetype'] += classifier.guess_type_seconds - watched[2]
+                watched[1], watched[2] = classifier.guess_type_calls, classifier.guess_type_seconds
+
+    # Метод для учёта просканированной директории: seconds - полное время сканирования,
+    # из которого stat_seconds и classify_seconds относятся к stat и классификации, остальное - к os.scandir
+    def add_directory(self, path, seconds, files, stat_calls, size, stat_seconds = 0.0, classify_seconds = 0.0):
+        report = False
+        with self._lock:
+            self.directories += 1
+            self.files += files
+            self.stat_calls += stat_calls
+            self.bytes += size
+            self.phase_times['scandir'] += seconds - stat_seconds - classify_seconds
+            self.phase_times['stat'] += stat_seconds
+            self.phase_times['classify'] += classify_seconds
+            self._push_slowest(seconds, path)
+            if self.progress is not None:
+                now = time.perf_counter()
+                if now - self._progress_time >= self.progress_interval:
+                    self._progress_time = now
+                    report = True
+        if report:
+            self.progress(self)
+
+    def _push_slowest(self, seconds, path):
+        if len(self.slowest_directories) < self.slowest:
+            heapq.heappush(self.slowest_directories, (seconds, path))
+        elif seconds > self.slowest_directories[0][0]:
+            heapq.heapreplace(self.slowest_directories, (seconds, path))
+
+    # Метод для увеличения счётчиков, например count(errors = 1)
+    def count(self, **counters):
+        with self._lock:
+            for name, value in counters.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def add_time(self, phase, seconds):
+        with self._lock:
+            self.phase_times[phase] += seconds
+
+    # Контекстный менеджер для измерения времени фазы phase
+    @contextlib.contextmanager
+    def timer(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.perf_counter() - start)
+
+    # Метод для объединения со статистикой другого калькулятора (например, из другого процесса)
+    def merge(self, other):
+        other.update_classifiers()
+        with self._lock:
+            for name in self.counters:
+                setattr(self, name, getattr(self, name) + getattr(other, name))
+            for phase, seconds in other.phase_times.items():
+                self.phase_times[phase] += seconds
+            for seconds, path in other.slowest_directories:
+                self._push_slowest(seconds, path)
+
+    def elapsed(self):
+        return time.perf_counter() - self.start_time
+
+    def get_slowest_directories(self):
+        return sorted(self.slowest_directories, reverse=True)
+
+    # Метод для получения статистики в виде словаря (например, для вывода в JSON)
+    def as_dict(self):
+        self.update_classifiers()
+        result = {name: getattr(self, name) for name in self.counters}
+        result['elapsed'] = self.elapsed()
+        result['phases'] = dict(self.phase_times)
+        result['slowest_directories'] = [{'path': path, 'seconds': seconds} for seconds, path in self.get_slowest_directories()]
+        return result
+
+# Кэш результатов сканирования в SQLite: для каждой директории хранятся mtime,
+# размер, количество (если известно) и детали её собственных файлов и список поддиректорий.
+# В одном файле кэша могут храниться результаты нескольких корней сканирования
+class ScanCache:
+    version = 3 # Версия содержимого кэша, кэш другой версии не используется
+
+    def __init__(self, path):
+        self.path = path
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path)
+        connection.execute('CREATE TABLE IF NOT EXISTS settings (root TEXT PRIMARY KEY, value TEXT)')
+        connection.execute('CREATE TABLE IF NOT EXISTS categories (root TEXT, id INTEGER, section TEXT, name TEXT, PRIMARY KEY (root, id))')
+        # Таблица кэша предыдущих версий без количества файлов пересоздаётся, её записи всё равно не используются
+        columns = [row[1] for row in connection.execute('PRAGMA table_info(directories)')]
+        if columns and 'files' not in columns:
+            connection.execute('DROP TABLE directories')
+        connection.execute('CREATE TABLE IF NOT EXISTS directories (root TEXT, path TEXT, mtime_ns INTEGER, size INTEGER, files INTEGER, subdirectories TEXT, detail BLOB, PRIMARY KEY (root, path))')
+        return connection
+
+    # Метод для загрузки записей кэша {путь: (mtime_ns, размер, поддиректории, вектор деталей, количество файлов)}
+    # Количество файлов None, если директория сканировалась без статистики
+    # Если кэш создан с другими настройками сканирования, он не используется
+    def load(self, root, settings, store):
+        records = {}
+        connection = self._connect()
+        try:
+            row = connection.execute('SELECT value FROM settings WHERE root = ?', (root,)).fetchone()
+            if row is None or row[0] != settings:
+                return records
+            # Идентификаторы категорий кэша переводятся в идентификаторы хранилища
+            category_ids = {}
+            for category_id, section, name in connection.execute('SELECT id, section, name FROM categories WHERE root = ?', (root,)):
+                category_ids[category_id] = store.category_id(section, name)
+            for path, mtime_ns, size, files, subdirectories, detail in connection.execute('SELECT path, mtime_ns, size, files, subdirectories, detail FROM directories WHERE root = ?', (root,)):
+                if mtime_ns is None:
+                    continue
+                if subdirectories:
+                    subdirectories = [os.path.join(path, name) for name in subdirectories.split('\0')]
+                else:
+                    subdirectories = []
+                vector = array.array('q')
+                vector.frombytes(detail)
+                vector[0::2] = array.array('q', [category_ids[category_id] for category_id in vector[0::2]])
+                records[path] = (mtime_ns, size, subdirectories, vector, files)
+        finally:
+            connection.close()
+        return records
+
+    # Метод для сохранения записей кэша, предыдущее содержимое для корня root заменяется
+    def save(self, root, settings, store, records):
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute('DELETE FROM settings WHERE root = ?', (root,))
+                connection.execute('DELETE FROM categories WHERE root = ?', (root,))
+                connection.execute('DELETE FROM directories WHERE root = ?', (root,))
+                connection.execute('INSERT INTO settings VALUES (?, ?)', (root, settings))
+                connection.executemany('INSERT INTO categories VALUES (?, ?, ?, ?)',
+                                       [(root, category_id, section, name) for category_id, (section, name) in enumerate(store.categories)])
+                connection.executemany('INSERT INTO directories VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                       [(root, path, mtime_ns, size, files, '\0'.join(os.path.basename(subdirectory) for subdirectory in subdirectories), vector.tobytes())
+                                        for path, (mtime_ns, size, subdirectories, vector, files) in records.items()])
+        finally:
+            connection.close()
+
+# Функция для компиляции glob-шаблонов: шаблоны без разделителя пути сравниваются с именем,
+# остальные - с полным путём. Возвращает (выражение для имён, выражение для путей), None - нет таких шаблонов
+def compile_patterns(patterns):
+    name_patterns = [fnmatch.translate(pattern) for pattern in patterns if os.sep not in pattern]
+    path_patterns = [fnmatch.translate(pattern) for pattern in patterns if os.sep in pattern]
+    return (re.compile('|'.join(name_patterns)) if name_patterns else None,
+            re.compile('|'.join(path_patterns)) if path_patterns else None)
+
+# Функция для проверки, подходит ли запись директории под шаблоны compile_patterns
+def match_patterns(patterns, entry):
+    name_regex, path_regex = patterns
+    return ((name_regex is not None and name_regex.match(entry.name) is not None)
+            or (path_regex is not None and path_regex.match(entry.path) is not None))
+
+# Функция для получения имени кода ошибки errno ('EACCES'), None - для ошибок без кода
+def errno_name(code):
+    if code is None:
+        return 'None'
+    return errno.errorcode.get(code, str(code))
+
+# Функция для вывода счётчиков ошибок по errno в виде строки 'EACCES: 10, ENOENT: 1'
+def format_error_counts(error_counts):
+    return ', '.join('%s: %d' % (errno_name(code), count) for code, count in error_counts.most_common())
+
+# Запись об ошибке сканирования: путь, код errno (None для исключений без кода),
+# фаза, в которой произошла ошибка ('scandir', 'stat'), и сообщение
+class ScanError(collections.namedtuple('ScanError', ['path', 'errno', 'phase', 'message'])):
+    __slots__ = ()
+
+    def __str__(self):
+        return '%s\t%s\t%s\t%s' % (self.phase, errno_name(self.errno), self.path, self.message)
+
+class DirectorySizeCalculator:
+    def __init__(self, workers = 1, size_mode = 'apparent', dedup_hardlinks = True, categories = None, cache = None, top = 0, top_by = None, processes = 1, stats = None, max_errors = 1000,
+                 exclude = None, include = None, one_file_system = False, detail = True):
         self.directory_sizes = {}
-        self.directory_sizes_detail = {} 
-        self.errors = []
+        self.detail_store = DirectoryDetailStore()
+        self.directory_sizes_detail = DirectoryDetailView(self.detail_store)
+        self.errors = [] # Записи ScanError, сохраняется не больше max_errors
+        self.max_errors = max_errors
+        self.error_count = 0 # Количество всех ошибок, включая не сохранённые
+        self.error_counts = collections.Counter() # Код errno -> количество ошибок
+        self.root_path = None # Путь, с которого начато сканирование
+        self.workers = workers # Количество потоков для параллельного сканирования
+        self.size_mode = size_mode # 'apparent' - размер файла (st_size), 'disk' - занятое место на диске (st_blocks * 512)
+        self.dedup_hardlinks = dedup_hardlinks # Учитывать жёсткие ссылки на один файл только один раз
+        self.categories = categories # Пользовательские типы файлов {"тип": [".ext", ...]}
+        self.processes = processes # Количество процессов для сканирования поддиректорий первого уровня
+        if processes > 1 and cache is not None:
+            raise ValueError('Сканирование в нескольких процессах не поддерживает кэш')
+        # Записи кэша не хранят отдельные файлы, поэтому самые большие файлы по ним не найти
+        if top and cache is not None:
+            raise ValueError('Поиск самых больших файлов и директорий не поддерживает кэш')
+        # Классификатор файлов, с пользовательскими категориями создаётся отдельный
+        if categories:
+            self.classifier = FileClassifier(categories)
+        else:
+            self.classifier = file_classifier
+        self.exclude = exclude # glob-шаблоны файлов и директорий, которые не сканируются
+        self.include = include # glob-шаблоны файлов, которые учитываются (директории обходятся все)
+        self.one_file_system = one_file_system # Не переходить в директории других файловых систем
+        self.root_device = None # st_dev корня сканирования при one_file_system
+        self._exclude_patterns = compile_patterns(exclude) if exclude else None
+        self._include_patterns = compile_patterns(include) if include else None
+        self._filter_entries_enabled = bool(exclude or include or one_file_system)
+        # При detail = False файлы не классифицируются, а поддеревья глубже max_depth
+        # считаются _size_files_in_directory без обхода по директориям
+        self.detail = detail
+        self.cache = None # Кэш для повторного сканирования только изменившихся директорий
+        if cache is not None:
+            self.cache = ScanCache(cache)
+        self.top = top # Количество самых больших файлов и директорий, которые нужно запомнить при сканировании
+        self.top_by = top_by # None, 'type' или 'ext' - дополнительно запоминать самые большие файлы каждого типа/расширения
+        self.top_files = [] # Куча (размер, путь) самых больших файлов
+        self.top_directories = [] # Куча (размер, путь) самых больших директорий
+        self.top_files_by_category = {} # Тип/расширение -> куча (размер, путь) самых больших файлов
+        # Статистика сканирования ScanStats: None - не собирается, True - создаётся новая,
+        # один объект ScanStats можно передать нескольким калькуляторам
+        if stats is True:
+            stats = ScanStats()
+        self.stats = stats or None
+        if self.stats is not None:
+            self.stats.watch_classifier(self.classifier)
+        self._top_lock = threading.Lock()
+        self._seen_inodes = set()
+        self._hardlinks = {} # Путь директории -> жёсткие ссылки, ещё не учтённые в порядке обхода
+        # В шарде (scan_shard) жёсткие ссылки не учитываются, а передаются в collect_shards:
+        # shard_hardlinks - список (директория, ссылки) в порядке обхода, None - ссылки учитываются здесь;
+        # shard_directory_sizes - размеры без этих ссылок директорий, в поддереве которых они есть (при top)
+        self.shard_hardlinks = None
+        self.shard_directory_sizes = {}
+        self._errors_lock = threading.Lock()
+        self._inodes_lock = threading.Lock()
+
+    # Блокировки не передаются между процессами и создаются заново
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ('_top_lock', '_errors_lock', '_inodes_lock', '_seen_inodes'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._top_lock = threading.Lock()
+        self._errors_lock = threading.Lock()
+        self._inodes_lock = threading.Lock()
+        self._seen_inodes = set()
+
+    # Параметры, с которыми создаются калькуляторы для сканирования поддиректорий в других процессах
+    def get_options(self):
+        return {'workers': self.workers, 'size_mode': self.size_mode, 'dedup_hardlinks': self.dedup_hardlinks,
+                'categories': self.categories, 'top': self.top, 'top_by': self.top_by, 'stats': self.stats is not None,
+                'max_errors': self.max_errors, 'exclude': self.exclude, 'include': self.include,
+                'one_file_system': self.one_file_system, 'detail': self.detail}
     
-    # Метод для сканирования директории
+    # Метод для учёта ошибки error, возникшей для пути path в фазе phase
+    # Файл журнала при этом не открывается, он записывается один раз методом write_error_log
+    def log_error(self, path, error, phase):
+        code = getattr(error, 'errno', None)
+        with self._errors_lock:
+            self.error_count += 1
+            self.error_counts[code] += 1
+            if len(self.errors) < self.max_errors:
+                if code is None:
+                    message = '%s: %s' % (type(error).__name__, error)
+                else:
+                    message = error.strerror or str(error)
+                self.errors.append(ScanError(path, code, phase, message))
+        if self.stats is not None:
+            self.stats.count(errors = 1)
+
+    # Метод для сканирования директории, при заданных фильтрах записи фильтруются до stat и обхода
     def scandir(self, directory):
         try:
-            return os.scandir(directory)
+            entries = os.scandir(directory)
         except Exception as error:
-            if len(self.errors) == 0:
-                file_mode = 'w' 
-            else:
-                file_mode = 'a'
-            self.errors.append(traceback.format_exc())  
-            with open("exceptions.log", file_mode) as logfile:
-                traceback.print_exc(file=logfile)
+            self.log_error(directory, error, 'scandir')
             return []
+        entries = self._read_entries(directory, entries)
+        if self._filter_entries_enabled:
+            return self._filter_entries(directory, entries)
+        return entries
 
-    # Метод для добавления деталей о файле в словарь directory_sizes_detail
+    # Генератор записей директории: ошибка чтения посреди списка (например, PermissionError
+    # в /proc/*/map_files) записывается в ошибки, уже прочитанные записи остаются в результате
+    def _read_entries(self, directory, entries):
+        with entries:
+            while True:
+                try:
+                    entry = next(entries)
+                except StopIteration:
+                    return
+                except OSError as error:
+                    self.log_error(directory, error, 'scandir')
+                    return
+                yield entry
+
+    # Генератор записей директории с учётом exclude, include и one_file_system
+    def _filter_entries(self, directory, entries):
+        if self.one_file_system and self.root_device is None:
+            # Первая сканируемая директория - корень сканирования
+            try:
+                self.root_device = os.stat(directory).st_dev
+            except OSError as error:
+                self.log_error(directory, error, 'stat')
+        for entry in entries:
+            if self._exclude_patterns is not None and match_patterns(self._exclude_patterns, entry):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                if self.one_file_system and self.root_device is not None:
+                    try:
+                        if entry.stat(follow_symlinks=False).st_dev != self.root_device:
+                            continue
+                    except OSError as error:
+                        self.log_error(entry.path, error, 'stat')
+                        continue
+            elif self._include_patterns is not None and not match_patterns(self._include_patterns, entry):
+                continue
+            yield entry
+
+    # Метод для получения размера файла из DirEntry.stat(): на POSIX это один вызов lstat на файл
+    # (как и у os.path.getsize), результат кэшируется в DirEntry; на Windows данные уже получены scandir
+    # Символические ссылки не разыменовываются, повторные жёсткие ссылки возвращают None
+    # Если передан список hardlinks, файлы с несколькими жёсткими ссылками не учитываются сразу,
+    # а добавляются в него как (st_dev, st_ino, размер, путь), и метод возвращает None
+    def entry_size(self, entry, hardlinks = None):
+        try:
+            stat = entry.stat(follow_symlinks=False)
+        except OSError as error:
+            self.log_error(entry.path, error, 'stat')
+            return None
+        if self.size_mode == 'disk' and hasattr(stat, 'st_blocks'):
+            filesize = stat.st_blocks * 512
+        else:
+            filesize = stat.st_size
+        if self.dedup_hardlinks and stat.st_nlink > 1:
+            if hardlinks is not None:
+                hardlinks.append((stat.st_dev, stat.st_ino, filesize, entry.path))
+                return None
+            inode = (stat.st_dev, stat.st_ino)
+            with self._inodes_lock:
+                if inode in self._seen_inodes:
+                    return None
+                self._seen_inodes.add(inode)
+        return filesize
+
+    # Метод для сохранения жёстких ссылок директории до их учёта методом _add_hardlinks
+    # Запись: (st_dev, st_ino, размер, путь, классификация файла или None без деталей)
+    def _defer_hardlinks(self, directory, hardlinks, detail):
+        self._hardlinks[directory] = self._classify_hardlinks(hardlinks, detail)
+
+    def _classify_hardlinks(self, hardlinks, detail):
+        classify = self.classifier.classify
+        return [(device, inode, filesize, filepath, classify(filepath) if detail else None)
+                for device, inode, filesize, filepath in hardlinks]
+
+    # Метод для учёта отложенных жёстких ссылок директории, возвращает размер директории с ними.
+    # Вызывается в порядке последовательного обхода, поэтому ссылка достаётся первой директории
+    # этого порядка независимо от того, в каком порядке директории сканировали потоки, кэш или процессы
+    # Детали добавляются в словарь vector, если он передан, иначе в detail_store
+    def _add_hardlinks(self, directory, dir_size, vector = None):
+        if self.shard_hardlinks is not None:
+            hardlinks = self._hardlinks.pop(directory, None)
+            if hardlinks is not None:
+                self.shard_hardlinks.append((directory, hardlinks))
+                if self.top:
+                    self.shard_directory_sizes.setdefault(directory, None)
+            return dir_size
+        files = 0
+        size = 0
+        for device, inode, filesize, filepath, file_class in self._hardlinks.pop(directory, ()):
+            if (device, inode) in self._seen_inodes:
+                continue
+            self._seen_inodes.add((device, inode))
+            files += 1
+            size += filesize
+            if self.top:
+                self._add_top_file(filepath, filesize)
+            if file_class is not None:
+                if vector is None:
+                    self.detail_store.add(directory, file_class, filesize)
+                else:
+                    self.detail_store.add_to_vector(vector, file_class, filesize)
+        if self.stats is not None and files:
+            self.stats.count(files = files, bytes = size)
+        return dir_size + size
+
+    # Метод для добавления деталей о файле в хранилище деталей директории
     def add_detail(self, directory, filepath, filesize = False):
-        if filesize == False:
+        if filesize is False:
             filesize = os.path.getsize(filepath) 
-        file_suffix = pathlib.Path(filepath).suffix.lower()
-         # Инициализация структуры данных для директории, если её ещё нет
-        if directory not in self.directory_sizes_detail:
-            self.directory_sizes_detail[directory] = {}
-        # Инициализация секции 'type', если её ещё нет
-        if 'type' not in self.directory_sizes_detail[directory]:
-            self.directory_sizes_detail[directory]['type'] = {} 
-        # Инициализация секции 'mimetype', если её ещё нет
-        if 'mimetype' not in self.directory_sizes_detail[directory]:
-            self.directory_sizes_detail[directory]['mimetype'] = {} 
-        # Инициализация секции 'ext', если её ещё нет
-        if 'ext' not in self.directory_sizes_detail[directory]:
-            self.directory_sizes_detail[directory]['ext'] = {}
-        # Классификация файлов по их расширениям
-        if file_suffix not in self.directory_sizes_detail[directory]['ext']:
-            self.directory_sizes_detail[directory]['ext'][file_suffix] = 0
-        self.directory_sizes_detail[directory]['ext'][file_suffix] += filesize
-        # Классификация файлов по типам (видео, изображения, документы и т.д.)
-        if file_suffix in ['.mp4', '.webm', '.avi', '.mkv', '.mov', '.ogg', '.wmv']:
-            if 'video' not in self.directory_sizes_detail[directory]['type']:
-                self.directory_sizes_detail[directory]['type']['video'] = 0
-            self.directory_sizes_detail[directory]['type']['video'] += filesize
-        elif file_suffix in ['.jpg', '.jpeg', '.png', '.bmp', '.gif', '.webp', '.tiff', '.tif']:
-            if 'image' not in self.directory_sizes_detail[directory]['type']:
-                self.directory_sizes_detail[directory]['type']['image'] = 0
-            self.directory_sizes_detail[directory]['type']['image'] += filesize
-        elif file_suffix in ['.txt', '.odt', '.ods', '.odp', '.html', 
-                             '.css', '.pdf', '.mhtml', '.xml', '.json', '.docx', '.djvu', '.djv',
-                             '.xls', '.xlsx', '.ppt', '.pptx', '.xml', '.md', '.markdown', '.yaml', '.yml']:
-            if 'doc' not in self.directory_sizes_detail[directory]['type']:
-                self.directory_sizes_detail[directory]['type']['doc'] = 0
-            self.directory_sizes_detail[directory]['type']['doc'] += filesize
-        elif file_suffix in source_code_extensions:
-            if 'source code' not in self.directory_sizes_detail[directory]['type']:
-                self.directory_sizes_detail[directory]['type']['source code'] = 0
-            self.directory_sizes_detail[directory]['type']['source code'] += filesize
-        elif file_suffix in excecutable_extensions:
-            if 'executable' not in self.directory_sizes_detail[directory]['type']:
-                self.directory_sizes_detail[directory]['type']['executable'] = 0
-            self.directory_sizes_detail[directory]['type']['executable'] += filesize
-        elif file_suffix in ['.iso', '.img']:
-            if 'disk image' not in self.directory_sizes_detail[directory]['type']:
-                self.directory_sizes_detail[directory]['type']['disk image'] = 0
-            self.directory_sizes_detail[directory]['type']['disk image'] += filesize
-        elif file_suffix in ['.vhd', '.vhdx', '.vmdk']:
-            if 'virtual machine image' not in self.directory_sizes_detail[directory]['type']:
-                self.directory_sizes_detail[directory]['type']['virtual machine image'] = 0
-            self.directory_sizes_detail[directory]['type']['virtual machine image'] += filesize
-        elif file_suffix in ['.db', '.mdb', '.sqlite', '.sql']:
-            if 'database' not in self.directory_sizes_detail[directory]['type']:
-                self.directory_sizes_detail[directory]['type']['database'] = 0
-            self.directory_sizes_detail[directory]['type']['database'] += filesize
-        elif file_suffix in ['.mp3', '.flac', '.m4a', '.wav', '.ogg']:
-            if 'audio' not in self.directory_sizes_detail[directory]['type']:
-                self.directory_sizes_detail[directory]['type']['audio'] = 0
-            self.directory_sizes_detail[directory]['type']['audio'] += filesize
-        elif file_suffix in ['.srt', '.ass', '.vtt']:
-            if 'sub' not in self.directory_sizes_detail[directory]['type']:
-                self.directory_sizes_detail[directory]['type']['sub'] = 0
-            self.directory_sizes_detail[directory]['type']['sub'] += filesize
-        elif file_suffix in ['.zip', '.rar', '.gzip', '.gz', '.tar', '.7z']:
-            if 'archive' not in self.directory_sizes_detail[directory]['type']:
-                self.directory_sizes_detail[directory]['type']['archive'] = 0
-            self.directory_sizes_detail[directory]['type']['archive'] += filesize
-        else:
-            if 'undefined' not in self.directory_sizes_detail[directory]['type']:
-                self.directory_sizes_detail[directory]['type']['undefined'] = 0
-            self.directory_sizes_detail[directory]['type']['undefined'] += filesize
-        # Классификация файлов по их MIME-типам
-        file_mimetype = mimetypes.guess_type(filepath)[0]
-        if file_mimetype == None:
-            file_mimetype = 'undefined'
-        if file_mimetype not in self.directory_sizes_detail[directory]['mimetype']:
-            self.directory_sizes_detail[directory]['mimetype'][file_mimetype] = 0
-        self.directory_sizes_detail[directory]['mimetype'][file_mimetype] += filesize
+        self.detail_store.add(directory, self.classifier.classify(filepath), filesize)
+
+    # Метод для добавления деталей поддиректории child к деталям директории directory
+    # При discard = True детали поддиректории после этого не хранятся
+    def merge_detail(self, directory, child, discard = False):
+        self.detail_store.merge(directory, child, discard)
+
+    # Метод для вычисления размера файлов в директории с учётом глубины
+    # При workers > 1 директории сканируются параллельно пулом потоков
+    def size_files_in_directory(self, directory, max_depth = 10, current_depth = 0, workers = None):
+        if workers is None:
+            workers = self.workers
+        if current_depth == 0:
+            self.root_path = directory
+            self.root_device = None
+        if self.processes > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.processes) as executor:
+                self.submit_shards(directory, max_depth, current_depth, executor)
+                return self.collect_shards()
+        if self.cache is not None:
+            return self._size_files_in_directory_cached(directory, max_depth, current_depth, workers)
+        if workers > 1:
+            return self._size_files_in_directory_parallel(directory, max_depth, current_depth, workers)
+        if not self.detail and not self.top:
+            # Размеры без деталей: поддеревья на максимальной глубине считаются одним проходом
+            return self._collect_directory_sizes(directory, max_depth, current_depth,
+                                                 functools.partial(self._scan_directory, detail = False), self._size_files_in_directory)
+        return self._collect_directory_sizes(directory, max_depth, current_depth, functools.partial(self._scan_directory, detail = self.detail))
+
+    # Метод для сканирования файлов одной директории без обхода поддиректорий
+    # Возвращает размер файлов директории и список поддиректорий
+    # Детали файлов добавляются в словарь деталей vector, если он передан, иначе в detail_store
+    # Файлы с несколькими жёсткими ссылками откладываются _defer_hardlinks и учитываются в _add_hardlinks
+    def _scan_directory(self, directory, detail = True, vector = None):
+        if self.stats is not None:
+            return self._scan_directory_with_stats(directory, detail, vector)
+        dir_size = 0
+        subdirectories = []
+        hardlinks = [] if self.dedup_hardlinks else None
+        for entry in self.scandir(directory):
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry.path)
+            elif entry.is_file(follow_symlinks=False) or entry.is_symlink():
+                filesize = self.entry_size(entry, hardlinks)
+                if filesize is not None:
+                    dir_size += filesize
+                    if self.top:
+                        self._add_top_file(entry.path, filesize)
+                    if not detail:
+                        continue
+                    if vector is None:
+                        self.add_detail(directory, entry.path, filesize)
+                    else:
+                        self.detail_store.add_to_vector(vector, self.classifier.classify(entry.path), filesize)
+        if hardlinks:
+            self._defer_hardlinks(directory, hardlinks, detail)
+        if detail and vector is None:
+            self.detail_store.finish(directory)
+        return (dir_size, subdirectories)
 
-    # Рекурсивный метод для вычисления размера файлов в директории с учётом глубины
-    def size_files_in_directory(self, directory, max_depth = 10, current_depth = 0):
+    # Вариант _scan_directory со сбором статистики: время stat и классификации измеряется для каждого файла,
+    # остальное время сканирования директории относится к os.scandir
+    # Если передан список file_counts, в него добавляется количество учтённых файлов директории
+    def _scan_directory_with_stats(self, directory, detail = True, vector = None, file_counts = None):
+        start = time.perf_counter()
+        stat_seconds = 0.0
+        classify_seconds = 0.0
+        files = 0
+        stat_calls = 0
         dir_size = 0
+        subdirectories = []
+        hardlinks = [] if self.dedup_hardlinks else None
+        for entry in self.scandir(directory):
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry.path)
+            elif entry.is_file(follow_symlinks=False) or entry.is_symlink():
+                stat_start = time.perf_counter()
+                filesize = self.entry_size(entry, hardlinks)
+                stat_seconds += time.perf_counter() - stat_start
+                stat_calls += 1
+                if filesize is not None:
+                    files += 1
+                    dir_size += filesize
+                    if self.top:
+                        self._add_top_file(entry.path, filesize)
+                    if not detail:
+                        continue
+                    classify_start = time.perf_counter()
+                    if vector is None:
+                        self.add_detail(directory, entry.path, filesize)
+                    else:
+                        self.detail_store.add_to_vector(vector, self.classifier.classify(entry.path), filesize)
+                    classify_seconds += time.perf_counter() - classify_start
+        if hardlinks:
+            classify_start = time.perf_counter()
+            self._defer_hardlinks(directory, hardlinks, detail)
+            classify_seconds += time.perf_counter() - classify_start
+        if detail and vector is None:
+            self.detail_store.finish(directory)
+        self.stats.add_directory(directory, time.perf_counter() - start, files, stat_calls, dir_size, stat_seconds, classify_seconds)
+        if file_counts is not None:
+            file_counts.append(files)
+        return (dir_size, subdirectories)
+
+    # Метод для сканирования дерева функцией scan_directory, возвращает {путь: (размер файлов, поддиректории)}
+    # При workers > 1 пул потоков забирает директории из очереди задач
+    def _scan_tree(self, directory, workers, scan_directory):
+        scanned = {}
+        if workers <= 1:
+            pending = [directory]
+            while pending:
+                path = pending.pop()
+                scanned[path] = scan_directory(path)
+                pending.extend(scanned[path][1])
+            return scanned
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = {executor.submit(scan_directory, directory): directory}
+            while pending:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    path = pending.pop(future)
+                    scanned[path] = future.result()
+                    for subdirectory in scanned[path][1]:
+                        pending[executor.submit(scan_directory, subdirectory)] = subdirectory
+        return scanned
+
+    # Параллельный обход: итоговые размеры собираются так же, как в последовательном обходе
+    def _size_files_in_directory_parallel(self, directory, max_depth, current_depth, workers):
+        scanned = self._scan_tree(directory, workers, functools.partial(self._scan_directory, detail = self.detail))
+        return self._collect_directory_sizes(directory, max_depth, current_depth, scanned.pop)
+
+    # Обход с кэшем: повторно сканируются только директории, mtime которых изменился.
+    # Изменение размера файла без изменения состава директории не меняет её mtime,
+    # такие изменения видны только при сканировании без кэша
+    def _size_files_in_directory_cached(self, directory, max_depth, current_depth, workers):
+        settings = json.dumps({'size_mode': self.size_mode, 'dedup_hardlinks': self.dedup_hardlinks, 'exclude': self.exclude, 'cache_version': ScanCache.version,
+                               'include': self.include, 'one_file_system': self.one_file_system,
+                               'file_types': sorted(self.classifier.file_type_table.items())}, ensure_ascii=False)
+        self._cache_records = self.cache.load(directory, settings, self.detail_store)
+        self._new_cache_records = {}
+        # Директории, изменённые незадолго до сканирования, могут измениться ещё раз с тем же mtime
+        self._cache_time_ns = time.time_ns() - 2 * 10**9
+        scanned = self._scan_tree(directory, workers, self._scan_directory_cached)
+        self.cache.save(directory, settings, self.detail_store, self._new_cache_records)
+        self._cache_records = self._new_cache_records = None
+        return self._collect_directory_sizes(directory, max_depth, current_depth, scanned.pop)
+
+    # Метод для сканирования директории с использованием записи кэша, если mtime не изменился
+    def _scan_directory_cached(self, directory):
+        start = time.perf_counter()
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+        except OSError:
+            mtime_ns = None
+        if self.stats is not None:
+            self.stats.add_time('stat', time.perf_counter() - start)
+            self.stats.count(stat_calls = 1)
+        record = self._cache_records.get(directory)
+        # Запись без количества файлов не подходит для статистики, директория сканируется заново
+        if record is not None and record[0] == mtime_ns and (self.stats is None or record[4] is not None):
+            dir_size, subdirectories, vector, files = record[1], record[2], record[3], record[4]
+            if vector:
+                self.detail_store.add_vector(directory, vector)
+            if self.stats is not None:
+                self.stats.count(directories = 1, files = files, bytes = dir_size, cache_hits = 1)
+        else:
+            error_count = self.error_count
+            if self.stats is None:
+                files = None
+                dir_size, subdirectories = self._scan_directory(directory)
+            else:
+                file_counts = []
+                dir_size, subdirectories = self._scan_directory_with_stats(directory, file_counts = file_counts)
+                files = file_counts[0]
+            vector = self.detail_store.get_vector(directory)
+            # Директории, при сканировании которых были ошибки, не кэшируются. Не кэшируются и директории
+            # с жёсткими ссылками: запись кэша хранит только размер без отложенных ссылок
+            if self.error_count != error_count or directory in self._hardlinks:
+                mtime_ns = None
+        if mtime_ns is not None and mtime_ns >= self._cache_time_ns:
+            mtime_ns = None
+        self._new_cache_records[directory] = (mtime_ns, dir_size, subdirectories, vector, files)
+        return (dir_size, subdirectories)
+
+    # Метод для обхода дерева в глубину без рекурсии с подсчётом итоговых размеров и деталей
+    # scan_directory(путь) возвращает размер файлов директории и список её поддиректорий
+    # subtree_size(путь), если передана, возвращает размер поддерева на максимальной глубине целиком
+    def _collect_directory_sizes(self, directory, max_depth, current_depth, scan_directory, subtree_size = None):
         if current_depth < max_depth:
             self.directory_sizes[directory] = (0, current_depth) # Инициализация записи для директории
-        for entry in self.scandir(directory):
-            if entry.is_file():
-                filesize = os.path.getsize(entry)
-                dir_size += filesize
-                self.add_detail(directory, entry.path, filesize)
-            elif entry.is_dir():
-                subdir_size = self.size_files_in_directory(entry.path, max_depth, current_depth + 1)
-                if current_depth < max_depth:
-                    self.directory_sizes[entry.path] = subdir_size
-                dir_size += subdir_size[0]
-                if entry.path in self.directory_sizes_detail:
-                    if directory not in self.directory_sizes_detail:
-                        self.directory_sizes_detail[directory] = {}
-                        self.directory_sizes_detail[directory]['type'] = {}
-                        self.directory_sizes_detail[directory]['ext'] = {}
-                        self.directory_sizes_detail[directory]['mimetype'] = {}
-                    for entry_size_detail_type, entry_size_detail_value in self.directory_sizes_detail[entry.path]['type'].items():
-                        if entry_size_detail_type not in self.directory_sizes_detail[directory]['type']:
-                            self.directory_sizes_detail[directory]['type'][entry_size_detail_type] = 0
-                        self.directory_sizes_detail[directory]['type'][entry_size_detail_type] += entry_size_detail_value
-                    for entry_size_detail_ext, entry_size_detail_value in self.directory_sizes_detail[entry.path]['ext'].items():
-                        if entry_size_detail_ext not in self.directory_sizes_detail[directory]['ext']:
-                            self.directory_sizes_detail[directory]['ext'][entry_size_detail_ext] = 0
-                        self.directory_sizes_detail[directory]['ext'][entry_size_detail_ext] += entry_size_detail_value
-                    for entry_size_detail_mimetype, entry_size_detail_value in self.directory_sizes_detail[entry.path]['mimetype'].items():
-                        if entry_size_detail_mimetype not in self.directory_sizes_detail[directory]['mimetype']:
-                            self.directory_sizes_detail[directory]['mimetype'][entry_size_detail_mimetype] = 0
-                        self.directory_sizes_detail[directory]['mimetype'][entry_size_detail_mimetype] += entry_size_detail_value
+        # Кадр стека: [путь, глубина, размер, поддиректории, индекс следующей поддиректории]
+        stack = [[directory, current_depth, *scan_directory(directory), 0]]
+        if self._hardlinks:
+            stack[-1][2] = self._add_hardlinks(directory, stack[-1][2])
+        while True:
+            frame = stack[-1]
+            if frame[4] < len(frame[3]):
+                path = frame[3][frame[4]]
+                frame[4] += 1
+                if subtree_size is not None and frame[1] + 1 >= max_depth:
+                    dir_size = subtree_size(path)
+                    if frame[1] + 1 <= max_depth:
+                        self.directory_sizes[path] = (dir_size, frame[1] + 1)
+                    frame[2] += dir_size
+                    continue
+                if frame[1] + 1 < max_depth:
+                    self.directory_sizes[path] = (0, frame[1] + 1)
+                stack.append([path, frame[1] + 1, *scan_directory(path), 0])
+                if self._hardlinks:
+                    stack[-1][2] = self._add_hardlinks(path, stack[-1][2])
+                continue
+            stack.pop()
+            path, depth, dir_size = frame[0], frame[1], frame[2]
+            if self.top:
+                if self.shard_directory_sizes and path in self.shard_directory_sizes:
+                    # Размер шарда без жёстких ссылок, в кучу директорию добавит collect_shards
+                    self.shard_directory_sizes[path] = dir_size
+                    if stack:
+                        self.shard_directory_sizes.setdefault(stack[-1][0], None)
+                else:
+                    self._push_top(self.top_directories, dir_size, path)
+            if not stack:
+                break
+            # Поддиректория записывается, если её родитель в пределах глубины
+            if depth <= max_depth:
+                self.directory_sizes[path] = (dir_size, depth)
+            stack[-1][2] += dir_size
+            if not self.detail:
+                continue
+            # Детали директорий глубже max_depth больше не нужны после добавления к родителю
+            if self.stats is None:
+                self.merge_detail(stack[-1][0], path, depth > max_depth)
+            else:
+                merge_start = time.perf_counter()
+                self.merge_detail(stack[-1][0], path, depth > max_depth)
+                self.stats.add_time('merge', time.perf_counter() - merge_start)
+        self.detail_store.finish(directory)
         if current_depth < max_depth:
             self.directory_sizes[directory] = (dir_size, current_depth)
         return (dir_size, current_depth)
     
+    # Генератор для потокового сканирования: записи директорий выдаются в порядке обхода
+    # в глубину (поддиректории раньше родителя), как только поддерево просканировано.
+    # В памяти хранятся только директории текущего пути, детали не сохраняются в detail_store
+    # Сканирование идёт в одном потоке: workers, processes и кэш калькулятора не используются
+    # Запись: {'path': путь, 'depth': глубина, 'size': размер, 'detail': детали или None}
+    def iter_directory_sizes(self, directory, max_depth = 10, detail = True):
+        self.root_path = directory
+        self.root_device = None
+        vector = {}
+        # Кадр стека: [путь, глубина, размер, поддиректории, индекс следующей поддиректории, словарь деталей]
+        stack = [[directory, 0, *self._scan_directory(directory, detail, vector), 0, vector]]
+        if self._hardlinks:
+            stack[-1][2] = self._add_hardlinks(directory, stack[-1][2], vector)
+        while stack:
+            frame = stack[-1]
+            if frame[4] < len(frame[3]):
+                path = frame[3][frame[4]]
+                frame[4] += 1
+                vector = {}
+                stack.append([path, frame[1] + 1, *self._scan_directory(path, detail, vector), 0, vector])
+                if self._hardlinks:
+                    stack[-1][2] = self._add_hardlinks(path, stack[-1][2], vector)
+                continue
+            stack.pop()
+            if self.top:
+                self._push_top(self.top_directories, frame[2], frame[0])
+            if stack:
+                stack[-1][2] += frame[2]
+                if detail:
+                    merge_start = time.perf_counter()
+                    self.detail_store.sum_vectors(stack[-1][5], frame[5])
+                    if self.stats is not None:
+                        self.stats.add_time('merge', time.perf_counter() - merge_start)
+            if frame[1] <= max_depth:
+                record = {'path': frame[0], 'depth': frame[1], 'size': frame[2], 'detail': None}
+                if detail:
+                    record['detail'] = self.detail_store.vector_detail(frame[5])
+                yield record
+
+    # Метод для вычисления размера поддерева одним проходом, жёсткие ссылки всего поддерева откладываются как ссылки directory
     def _size_files_in_directory(self, directory):
+        if self.stats is not None:
+            return self._size_files_in_directory_with_stats(directory)
         dir_size = 0
-        for entry in self.scandir(directory):
-            if entry.is_file():
-                dir_size += os.path.getsize(entry)
-            elif entry.is_dir():
-                dir_size += self._size_files_in_directory(entry.path)
+        hardlinks = [] if self.dedup_hardlinks else None
+        pending = [directory]
+        while pending:
+            for entry in self.scandir(pending.pop()):
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                elif entry.is_file(follow_symlinks=False) or entry.is_symlink():
+                    filesize = self.entry_size(entry, hardlinks)
+                    if filesize is not None:
+                        dir_size += filesize
+        if hardlinks:
+            self._defer_hardlinks(directory, hardlinks, False)
+            dir_size = self._add_hardlinks(directory, dir_size)
         return dir_size
 
+    # Вариант _size_files_in_directory со сбором статистики по каждой директории поддерева
+    # Файлы не хронометрируются по отдельности, поэтому время stat входит в фазу scandir
+    def _size_files_in_directory_with_stats(self, directory):
+        subtree_size = 0
+        hardlinks = [] if self.dedup_hardlinks else None
+        pending = [directory]
+        while pending:
+            path = pending.pop()
+            start = time.perf_counter()
+            files = 0
+            stat_calls = 0
+            dir_size = 0
+            for entry in self.scandir(path):
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                elif entry.is_file(follow_symlinks=False) or entry.is_symlink():
+                    stat_calls += 1
+                    filesize = self.entry_size(entry, hardlinks)
+                    if filesize is not None:
+                        files += 1
+                        dir_size += filesize
+            self.stats.add_directory(path, time.perf_counter() - start, files, stat_calls, dir_size)
+            subtree_size += dir_size
+        if hardlinks:
+            self._defer_hardlinks(directory, hardlinks, False)
+            subtree_size = self._add_hardlinks(directory, subtree_size)
+        return subtree_size
+
+    # Метод для сканирования директории с распределением её поддиректорий по пулу процессов executor:
+    # собственные файлы директории сканируются в текущем процессе, каждая поддиректория - отдельной задачей.
+    # Результаты собираются методом collect_shards, поэтому несколько корней могут использовать один пул
+    def submit_shards(self, directory, max_depth, current_depth, executor):
+        if current_depth == 0:
+            self.root_path = directory
+            self.root_device = None
+        if current_depth < max_depth:
+            self.directory_sizes[directory] = (0, current_depth)
+        dir_size, subdirectories = self._scan_directory(directory, self.detail)
+        options = self.get_options()
+        shards = [(subdirectory, executor.submit(scan_shard, options, subdirectory, max_depth, current_depth + 1)) for subdirectory in subdirectories]
+        self._shards = (directory, max_depth, current_depth, dir_size, shards)
+
+    # Метод для объединения результатов задач submit_shards, возвращает (размер, глубина) директории
+    def collect_shards(self):
+        directory, max_depth, current_depth, dir_size, shards = self._shards
+        self._shards = None
+        dir_size = self._add_hardlinks(directory, dir_size)
+        for subdirectory, future in shards:
+            shard, subdir_size = future.result()
+            self.merge(shard)
+            subdir_size = self._add_shard_hardlinks(shard, subdirectory, subdir_size)
+            if current_depth < max_depth:
+                self.directory_sizes[subdirectory] = subdir_size
+            dir_size += subdir_size[0]
+            merge_start = time.perf_counter()
+            self.merge_detail(directory, subdirectory, current_depth + 1 > max_depth)
+            if self.stats is not None:
+                self.stats.add_time('merge', time.perf_counter() - merge_start)
+        self.detail_store.finish(directory)
+        if self.top:
+            self._push_top(self.top_directories, dir_size, directory)
+        if current_depth < max_depth:
+            self.directory_sizes[directory] = (dir_size, current_depth)
+        return (dir_size, current_depth)
+
+    # Метод для учёта жёстких ссылок, переданных шардом subdirectory в порядке его обхода: ссылки
+    # учитываются в общем для всех шардов множестве inode, размер ссылки, встреченной впервые, добавляется
+    # к её директории и всем родителям до subdirectory. Возвращает (размер, глубина) шарда с ссылками
+    def _add_shard_hardlinks(self, shard, subdirectory, subdir_size):
+        added = collections.Counter() # Путь -> размер добавленных ссылок
+        files = 0
+        for directory, hardlinks in shard.shard_hardlinks or ():
+            for device, inode, filesize, filepath, file_class in hardlinks:
+                if (device, inode) in self._seen_inodes:
+                    continue
+                self._seen_inodes.add((device, inode))
+                files += 1
+                if self.top:
+                    self._add_top_file(filepath, filesize)
+                path = directory
+                while True:
+                    added[path] += filesize
+                    # Детали хранятся для директорий в пределах глубины и для корня шарда
+                    if file_class is not None and (path == subdirectory or path in self.directory_sizes):
+                        self.detail_store.add(path, file_class, filesize)
+                    if path == subdirectory or os.path.dirname(path) == path:
+                        break
+                    path = os.path.dirname(path)
+        for path, size in added.items():
+            if path in self.directory_sizes:
+                self.directory_sizes[path] = (self.directory_sizes[path][0] + size, self.directory_sizes[path][1])
+            self.detail_store.finish(path)
+        if self.top:
+            for path, size in shard.shard_directory_sizes.items():
+                self._push_top(self.top_directories, size + added[path], path)
+        if self.stats is not None and files:
+            self.stats.count(files = files, bytes = added[subdirectory])
+        return (subdir_size[0] + added[subdirectory], subdir_size[1])
+
+    # Метод для объединения с результатами другого калькулятора (например, просканированного в другом процессе)
+    # directory_sizes обоих калькуляторов должны быть словарями "путь -> (размер, глубина)"
+    # Размеры и детали директорий, которые есть в обоих калькуляторах, складываются
+    def merge(self, other):
+        for path, (size, depth) in other.directory_sizes.items():
+            if path in self.directory_sizes:
+                size += self.directory_sizes[path][0]
+            self.directory_sizes[path] = (size, depth)
+        self.detail_store.merge_store(other.detail_store)
+        self.errors.extend(other.errors[:max(self.max_errors - len(self.errors), 0)])
+        self.error_count += other.error_count
+        self.error_counts.update(other.error_counts)
+        if self.stats is not None and other.stats is not None:
+            self.stats.merge(other.stats)
+        if self.top:
+            for size, path in other.top_files:
+                self._push_top(self.top_files, size, path)
+            for size, path in other.top_directories:
+                self._push_top(self.top_directories, size, path)
+            for category, heap in other.top_files_by_category.items():
+                for size, path in heap:
+                    self._push_top(self.top_files_by_category.setdefault(category, []), size, path)
+
+    # Метод для поиска самых больших файлов и директорий без построения дерева и directory_sizes
+    def find_top(self, directory, workers = None):
+        if workers is None:
+            workers = self.workers
+        self.root_path = directory
+        self.root_device = None
+        scan_directory = functools.partial(self._scan_directory, detail = False)
+        if workers > 1:
+            scan_directory = self._scan_tree(directory, workers, scan_directory).pop
+        self._collect_directory_sizes(directory, -1, 0, scan_directory)
+
+    # Метод для добавления элемента в кучу self.top самых больших элементов, O(log N)
+    def _push_top(self, heap, size, path):
+        if len(heap) < self.top or size > heap[0][0]:
+            with self._top_lock:
+                if len(heap) < self.top:
+                    heapq.heappush(heap, (size, path))
+                elif size > heap[0][0]:
+                    heapq.heapreplace(heap, (size, path))
+
+    # Метод для добавления файла в кучи самых больших файлов
+    def _add_top_file(self, filepath, filesize):
+        self._push_top(self.top_files, filesize, filepath)
+        if self.top_by is not None:
+            file_type, file_suffix, file_mimetype = self.classifier.classify(filepath)
+            if self.top_by == 'ext':
+                category = file_suffix
+            else:
+                category = file_type
+            self._push_top(self.top_files_by_category.setdefault(category, []), filesize, filepath)
+
+    # Методы для получения самых больших файлов и директорий в виде списков (размер, путь) по убыванию размера
+    def get_top_files(self):
+        return sorted(self.top_files, reverse=True)
+
+    def get_top_directories(self):
+        return sorted(self.top_directories, reverse=True)
+
+    def get_top_files_by_category(self):
+        return {category: sorted(heap, reverse=True) for category, heap in sorted(self.top_files_by_category.items())}
+
     def get_errors(self):
         return self.errors
+
+    def get_error_counts(self):
+        return self.error_counts
     
     def print_errors(self):
         for error in self.errors:
             print(error)
 
+    # Метод для записи сохранённых ошибок и счётчиков по errno в файл path за одну операцию записи
+    def write_error_log(self, path, append = False):
+        lines = [str(error) for error in self.errors]
+        if self.error_count > len(self.errors):
+            lines.append('Сохранено %d из %d ошибок' % (len(self.errors), self.error_count))
+        lines.append('Ошибки по errno: ' + format_error_counts(self.error_counts))
+        with open(path, 'a' if append else 'w') as logfile:
+            logfile.write('\n'.join(lines) + '\n')
+
     def find_root(self):
+        if self.root_path is not None and self.root_path in self.directory_sizes:
+            return self.root_path # Корень, записанный при сканировании
         root_path = max(self.directory_sizes.keys(), key=lambda x: self.directory_sizes[x][0])  # Находим путь с максимальным размером
-        root_size, root_level = self.directory_sizes[root_path]
         return root_path
 
     # Функция для создания вложенной структуры
-    def build_nested_structure(self):
-        # Создаем корневой элемент
+    # Директории в directory_sizes идут после своих родителей, поэтому узлы
+    # связываются через индекс "путь -> узел" за один проход
+    # При detail = False детали в узлы не добавляются
+    def build_nested_structure(self, detail = True):
+        start = time.perf_counter()
         root_path = self.find_root()
         self.root_path = root_path
-        root_name_len = len(root_path)
-        root = {"name": os.path.basename(root_path), "size": self.directory_sizes[root_path][0], "detail": self.directory_sizes_detail[root_path], "children": []}
-        # Вспомогательная функция для добавления элементов в структуру
-        def add_to_structure(parent, path_parts, size, level):
-            if level >= len(path_parts):
-                return
-            current_name = path_parts[level]
-            
-            # Ищем, есть ли уже такой элемент в текущем уровне
-            for child in parent["children"]:
-                if child["name"] == current_name:
-                    add_to_structure(child, path_parts, size, level + 1)
-                    return
-            
-            # Если элемент не найден, создаем новый
-            new_child = {"name": current_name, "size": size, "detail": self.get_directory_sizes_detail(self.root_path + '/' + '/'.join(path_parts)), "children": []}
-            parent["children"].append(new_child)
-            add_to_structure(new_child, path_parts, size, level + 1)
-        
-        # Обрабатываем каждый элемент в данных
+        nodes = {}
+        root = None
         for path, (size, level) in self.directory_sizes.items():
-            if level == 0:
-                continue  # Корневой элемент уже создан
-            path = path[root_name_len + 1:]
-            path_parts = path.split('/')
-            add_to_structure(root, path_parts, size, 0)
-        
+            if path == root_path:
+                parent = None
+            else:
+                parent = nodes.get(os.path.dirname(path))
+                if parent is None:
+                    continue # Директория вне дерева корня
+            node = {"name": os.path.basename(path), "size": size, "detail": None, "children": []}
+            if detail:
+                node["detail"] = self.get_directory_sizes_detail(path)
+            nodes[path] = node
+            if parent is None:
+                root = node
+                # Для корня с завершающим разделителем ('/', 'dir/') дочерние пути дают имя без него
+                nodes[path.rstrip(os.sep) or path] = node
+            else:
+                parent["children"].append(node)
         self.directory_sizes = root
+        if self.stats is not None:
+            self.stats.add_time('build', time.perf_counter() - start)
 
     def get_directory_sizes_detail(self, path):
-        if path not in self.directory_sizes_detail:
-            return {'type': {}, 'ext' : {}, 'mimetype': {}}
-        return self.directory_sizes_detail[path]
+        return self.detail_store.detail(path)
             
     def sort_by_size(self, node, reverse=True):
-        if isinstance(node, dict) and "children" in node:
-            node["children"].sort(key=lambda x: x["size"], reverse=reverse)
-            for child in node["children"]:
-                self.sort_by_size(child, reverse=reverse)
-        else:
-            print("Ошибка: Некорректная структура данных!")
+        self._sort_nodes(node, operator.itemgetter("size"), reverse)
 
     def sort_by_name(self, node, reverse=False):
-        if isinstance(node, dict) and "children" in node:
-            node["children"].sort(key=lambda x: x["name"], reverse=reverse)
-            for child in node["children"]:
-                self.sort_by_name(child, reverse=reverse)
-        else:
-            print("Ошибка: Некорректная структура данных!")
+        self._sort_nodes(node, operator.itemgetter("name"), reverse)
 
-def print_node(node, parent = '', level = 0, detail = False, detail_ext = False, detail_mimetype = False):
-    size = human_readable_size(int(node['size']))
+    # Метод для сортировки дочерних элементов всех узлов дерева без рекурсии
+    def _sort_nodes(self, node, key, reverse):
+        start = time.perf_counter()
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, dict) and "children" in node:
+                node["children"].sort(key=key, reverse=reverse)
+                stack.extend(node["children"])
+            else:
+                print("Ошибка: Некорректная структура данных!")
+        if self.stats is not None:
+            self.stats.add_time('sort', time.perf_counter() - start)
+
+# Функция для переноса текста по ширине width, возвращает список строк
+# textwrap вызывается только для строк, которые не помещаются в ширину
+def wrap_text(text, width):
+    if len(text) <= width and '\t' not in text and not text[-1:].isspace():
+        return text.split('\n')
+    return textwrap.fill(text, width, replace_whitespace = False).split('\n')
+
+# Функция для вывода дерева в file (по умолчанию sys.stdout): строки накапливаются
+# в буфере и записываются блоками, узлы обходятся в глубину с помощью явного стека
+# min_percent - не выводить узлы, размер которых меньше min_percent % от размера родителя
+# max_level - не выводить узлы глубже max_level
+def render_node(node, file = None, detail = False, detail_ext = False, detail_mimetype = False, min_percent = 0, max_level = None, level = 0):
+    if file is None:
+        file = sys.stdout
     interface_width = 100
+    separator = '-' * interface_width
+    # Секции деталей и признак дополнения строк пробелами до ширины вывода
+    sections = [(section, padded) for section, padded, enabled in (('type', False, detail), ('ext', True, detail_ext), ('mimetype', True, detail_mimetype)) if enabled]
+    lines = []
     if level == 0:
-        print('-' * (level * 3) + '-' * (100 - (level * 3)))
-    #print(' ' * (level * 3) + '-' * (100 - (level * 3)))
-    node_name = ' ' * (level * 3) + node['name']
-    node_name = textwrap.fill(node_name, interface_width, replace_whitespace = False)
-    node_name = node_name.split('\n')
-    i = 0
-    for node_name_part in node_name:
-        if i != 0:
-            print(' ' * (level * 3), end="")
-        print(node_name_part, end="")
-        print('')
-        i += 1
-    print(' ' * (level * 3), end="")
-    print(size)
-    if detail == True: 
-        i_file_type_size = 0
-        print_file_type_size = []
-        node['detail']['type'] = dict(sorted(node['detail']['type'].items()))
-        for file_type, file_type_size in node['detail']['type'].items():
-            if file_type_size > 0:
-                print_file_type_size.append(str(file_type) + ':' + str(human_readable_size(file_type_size)),)
-            i_file_type_size += 1
-        if i_file_type_size > 0:
-            detail_output = ', '.join(print_file_type_size)
-            detail_output = textwrap.fill(detail_output, interface_width - (level * 3), replace_whitespace = False)
-            detail_output = detail_output.split('\n')
-            i = 0
-            for detail_output_part in detail_output:
-                if i != 0:
-                    print('', end="")
-                print(' ' * (level * 3), end="")
-                print(detail_output_part, end="")
-                print('')
-                i += 1
-    if detail_ext == True: 
-        i_file_ext_size = 0
-        print_file_ext_size = []
-        node['detail']['ext'] = dict(sorted(node['detail']['ext'].items()))
-        for file_ext, file_ext_size in node['detail']['ext'].items():
-            if file_ext_size > 0:
-                print_file_ext_size.append(str(file_ext) + ':' + str(human_readable_size(file_ext_size)),)
-            i_file_ext_size += 1
-        if i_file_ext_size > 0:
-            detail_ext_output = ', '.join(print_file_ext_size)
-            detail_ext_output = textwrap.fill(detail_ext_output, interface_width - (level * 3), replace_whitespace = False)
-            detail_ext_output = detail_ext_output.split('\n')
-            i = 0
-            for detail_ext_output_part in detail_ext_output:
-                if i != 0:
-                    print('', end="")
-                print(' ' * (level * 3), end="")
-                print(detail_ext_output_part, end="")
-                print(' ' * (interface_width - len(detail_ext_output_part)), end="")
-                print('')
-                i += 1
-    if detail_mimetype == True: 
-        i_file_mimetype_size = 0
-        print_file_mimetype_size = []
-        node['detail']['mimetype'] = dict(sorted(node['detail']['mimetype'].items()))
-        for file_mimetype, file_mimetype_size in node['detail']['mimetype'].items():
-            if file_mimetype_size > 0:
-                print_file_mimetype_size.append(str(file_mimetype) + ':' + str(human_readable_size(file_mimetype_size)),)
-            i_file_mimetype_size += 1
-        if i_file_mimetype_size > 0:
-            detail_mimetype_output = ', '.join(print_file_mimetype_size)
-            detail_mimetype_output = textwrap.fill(detail_mimetype_output, interface_width - (level * 3), replace_whitespace = False)
-            detail_mimetype_output = detail_mimetype_output.split('\n')
-            i = 0
-            for detail_mimetype_output_part in detail_mimetype_output:
-                if i != 0:
-                    print('', end="")
-                print(' ' * (level * 3), end="")
-                print(detail_mimetype_output_part, end="")
-                print(' ' * (interface_width - len(detail_mimetype_output_part)), end="")
-                print('')
-                i += 1    
-    last_index = len(node['children']) - 1
-    #if level == 0:
-    print('-' * (level * 3) + '-' * (100 - (level * 3)))
-    for i, children in enumerate(node['children']):
-        #if i == last_index:
-            #print(' ' * (level * 3) + '-' * (100 - (level * 3)))
-        if level == 0:
-            print_node(children, '', level + 1, detail, detail_ext, detail_mimetype)
+        lines.append(separator)
+    stack = [(node, level)]
+    while stack:
+        node, level = stack.pop()
+        indent = ' ' * (level * 3)
+        node_name = wrap_text(indent + node['name'], interface_width)
+        lines.append(node_name[0])
+        for node_name_part in node_name[1:]:
+            lines.append(indent + node_name_part)
+        lines.append(indent + human_readable_size(int(node['size'])))
+        detail_width = interface_width - (level * 3)
+        if detail_width <= 0:
+            detail_width = interface_width
+        for section, padded in sections:
+            section_sizes = node['detail'][section]
+            if len(section_sizes) == 0:
+                continue
+            detail_output = ', '.join([str(name) + ':' + human_readable_size(size) for name, size in sorted(section_sizes.items()) if size > 0])
+            for detail_output_part in wrap_text(detail_output, detail_width):
+                if padded:
+                    lines.append(indent + detail_output_part + ' ' * (interface_width - len(detail_output_part)))
+                else:
+                    lines.append(indent + detail_output_part)
+        lines.append(separator)
+        if max_level is None or level < max_level:
+            for children in reversed(node['children']):
+                if min_percent and children['size'] * 100 < node['size'] * min_percent:
+                    continue
+                stack.append((children, level + 1))
+        if len(lines) >= 8192:
+            file.write('\n'.join(lines) + '\n')
+            lines = []
+    if lines:
+        file.write('\n'.join(lines) + '\n')
+
+def print_node(node, parent = '', level = 0, detail = False, detail_ext = False, detail_mimetype = False):
+    render_node(node, sys.stdout, detail, detail_ext, detail_mimetype, level = level)
+
+# Функция для сканирования поддерева в отдельном процессе, возвращает калькулятор и (размер, глубина) поддерева
+# Жёсткие ссылки шарда не учитываются в его размерах, их учитывает collect_shards вместе с другими шардами
+def scan_shard(options, directory, max_depth, current_depth):
+    size_canculator = DirectorySizeCalculator(**options)
+    size_canculator.shard_hardlinks = []
+    subdir_size = size_canculator.size_files_in_directory(directory, max_depth, current_depth)
+    return (size_canculator, subdir_size)
+
+# Функция для сканирования нескольких корней, возвращает список калькуляторов в порядке paths
+# При processes > 1 поддиректории первого уровня всех корней сканируются общим пулом процессов
+def scan_roots(paths, max_depth = 10, processes = 1, **options):
+    calculators = [DirectorySizeCalculator(**options) for path in paths]
+    if processes <= 1:
+        for size_canculator, path in zip(calculators, paths):
+            size_canculator.size_files_in_directory(path, max_depth)
+        return calculators
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        for size_canculator, path in zip(calculators, paths):
+            size_canculator.submit_shards(path, max_depth, 0, executor)
+        for size_canculator in calculators:
+            size_canculator.collect_shards()
+    return calculators
+
+# Калькулятор для сканирования отдельных директорий в AsyncDirectorySizeCalculator:
+# ошибки и отложенные жёсткие ссылки сохраняются в текущем потоке и возвращаются вместе
+# с результатом директории. Общего множества жёстких ссылок нет, повторы отбрасывает каждый запрос отдельно
+class DirectoryScanner(DirectorySizeCalculator):
+    def __init__(self, **options):
+        super().__init__(**options)
+        self._local = threading.local()
+
+    def log_error(self, path, error, phase):
+        self._local.errors.append((path, error, phase))
+
+    def _defer_hardlinks(self, directory, hardlinks, detail):
+        self._local.hardlinks = self._classify_hardlinks(hardlinks, detail)
+
+    # Метод для сканирования одной директории, возвращает (размер, поддиректории, вектор деталей,
+    # жёсткие ссылки, ошибки); жёсткие ссылки - записи _defer_hardlinks, не вошедшие в размер и вектор
+    def scan(self, directory, detail = True):
+        self._local.errors = []
+        self._local.hardlinks = []
+        vector = {}
+        dir_size, subdirectories = self._scan_directory(directory, detail, vector)
+        return (dir_size, subdirectories, vector, self._local.hardlinks, self._local.errors)
+
+# Асинхронное сканирование для asyncio-приложений: директории сканируются в пуле потоков,
+# одновременно выполняется не больше concurrency сканирований директорий.
+# Выполняющиеся сканирования хранятся в in_flight ("(путь, detail) -> (задача, событие начала сканирования)"), поэтому
+# одновременные запросы для пересекающихся путей сканируют каждую директорию один раз.
+# Жёсткие ссылки учитываются один раз в пределах запроса, независимо от других запросов
+class AsyncDirectorySizeCalculator:
+    def __init__(self, concurrency = 8, executor = None, size_mode = 'apparent', dedup_hardlinks = True, categories = None, max_errors = 1000):
+        self.concurrency = concurrency
+        self.options = {'size_mode': size_mode, 'dedup_hardlinks': dedup_hardlinks, 'max_errors': max_errors}
+        self.scanner = DirectoryScanner(categories = categories, **self.options)
+        self.own_executor = executor is None
+        if executor is None:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+        self.executor = executor
+        self.in_flight = {}
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    # Метод для остановки собственного пула потоков, сканирования в очереди отменяются
+    def close(self):
+        if self.own_executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    # Метод для сканирования дерева directory, возвращает DirectorySizeCalculator с результатами,
+    # как после size_files_in_directory
+    # timeout - ограничение времени всего запроса (asyncio.TimeoutError)
+    # directory_timeout - ограничение времени сканирования одной директории, считая с его начала
+    # (ожидание свободного места в concurrency не учитывается): поддерево директории,
+    # не просканированной за это время, пропускается и записывается как ошибка ETIMEDOUT,
+    # а поток пула остаётся занят, пока зависшее сканирование не завершится
+    async def size_files_in_directory(self, directory, max_depth = 10, detail = True, timeout = None, directory_timeout = None):
+        scanned, errors = await asyncio.wait_for(self._scan_tree(directory, detail, directory_timeout), timeout)
+        # Подсчёт итогов занимает время, пропорциональное количеству директорий, и выполняется в пуле потоков,
+        # чтобы не останавливать цикл событий
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self._collect_result, directory, max_depth, scanned, errors)
+
+    # Метод для построения калькулятора с результатами запроса из результатов сканирования директорий _scan_tree
+    def _collect_result(self, directory, max_depth, scanned, errors):
+        size_canculator = DirectorySizeCalculator(**self.options)
+        size_canculator.categories = self.scanner.categories
+        size_canculator.classifier = self.scanner.classifier
+        size_canculator.root_path = directory
+        # Идентификаторы категорий результата совпадают с идентификаторами сканера
+        store = size_canculator.detail_store
+        for section, name in list(self.scanner.detail_store.categories):
+            store.category_id(section, name)
+        for path, (dir_size, subdirectories, vector, hardlinks) in scanned.items():
+            if vector:
+                store.add_vector(path, vector)
+            if hardlinks:
+                size_canculator._hardlinks[path] = hardlinks
+            scanned[path] = (dir_size, subdirectories)
+        for path, error, phase in errors:
+            size_canculator.log_error(path, error, phase)
+        size_canculator._collect_directory_sizes(directory, max_depth, 0, scanned.pop)
+        return size_canculator
+
+    # Метод для обхода дерева: одновременно ожидается не больше concurrency директорий,
+    # возвращает {путь: (размер, поддиректории, вектор, жёсткие ссылки)} и список ошибок (путь, ошибка, фаза)
+    async def _scan_tree(self, directory, detail, directory_timeout):
+        scanned = {}
+        errors = []
+        queue = [directory]
+        running = {} # Задача ожидания -> путь
+        try:
+            while queue or running:
+                while queue and len(running) < self.concurrency:
+                    path = queue.pop()
+                    running[asyncio.ensure_future(self._scan_directory(path, detail, directory_timeout))] = path
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    path = running.pop(future)
+                    try:
+                        dir_size, subdirectories, vector, hardlinks, directory_errors = future.result()
+                    except asyncio.TimeoutError:
+                        dir_size, subdirectories, vector, hardlinks, directory_errors = 0, [], None, [], [(path, TimeoutError(errno.ETIMEDOUT, 'Превышено время ожидания директории'), 'timeout')]
+                    scanned[path] = (dir_size, subdirectories, vector, hardlinks)
+                    errors.extend(directory_errors)
+                    queue.extend(subdirectories)
+        finally:
+            # При отмене запроса отменяется только ожидание, общие задачи сканирования защищены shield
+            for future in running:
+                future.cancel()
+        return scanned, errors
+
+    # Метод для ожидания сканирования директории: задача берётся из in_flight или создаётся новая
+    # Результат сканирования с деталями подходит и для запросов без деталей
+    # Время ожидания timeout отсчитывается с начала сканирования, очередь семафора в него не входит
+    async def _scan_directory(self, path, detail, timeout):
+        scan = self.in_flight.get((path, True))
+        if scan is None:
+            scan = self.in_flight.get((path, detail))
+        if scan is None:
+            key = (path, detail)
+            started = asyncio.Event()
+            task = asyncio.ensure_future(self._run_scan(path, detail, started))
+            scan = self.in_flight[key] = (task, started)
+            task.add_done_callback(lambda task: self._scan_done(key, task))
+        task, started = scan
+        if timeout is not None:
+            await started.wait()
+        return await asyncio.wait_for(asyncio.shield(task), timeout)
+
+    # Метод для сканирования директории в пуле потоков, started устанавливается после захвата семафора
+    # (или при завершении задачи, не дошедшей до сканирования)
+    async def _run_scan(self, path, detail, started):
+        try:
+            async with self._semaphore:
+                started.set()
+                return await asyncio.get_running_loop().run_in_executor(self.executor, self.scanner.scan, path, detail)
+        finally:
+            started.set()
+
+    def _scan_done(self, key, task):
+        if self.in_flight.get(key, (None,))[0] is task:
+            del self.in_flight[key]
+        if not task.cancelled():
+            task.exception() # Исключение уже получено ожидающими запросами
+
+# Функция для вывода списка (размер, путь) с заголовком
+def print_top_items(title, items):
+    print(title)
+    for size, path in items:
+        print(human_readable_size(size).rjust(12) + '  ' + path)
+    print('')
+
+# Функция для вывода хода сканирования одной строкой в sys.stderr, используется как progress для ScanStats
+def print_progress(stats):
+    sys.stderr.write('\rДиректорий: %d, файлов: %d, размер: %s, ошибок: %d, прошло: %.1f с' %
+                     (stats.directories, stats.files, human_readable_size(stats.bytes), stats.errors, stats.elapsed()))
+    sys.stderr.flush()
+
+# Функция для вывода статистики сканирования в file (по умолчанию sys.stderr)
+def print_stats(stats, file = None):
+    if file is None:
+        file = sys.stderr
+    stats.update_classifiers()
+    print('Статистика сканирования:', file=file)
+    print('  Директорий: %d, файлов: %d, вызовов stat: %d, ошибок: %d, размер: %s' %
+          (stats.directories, stats.files, stats.stat_calls, stats.errors, human_readable_size(stats.bytes)), file=file)
+    if stats.cache_hits:
+        print('  Директорий из кэша: %d' % stats.cache_hits, file=file)
+    print('  Вызовов mimetypes.guess_type: %d' % stats.mimetype_guesses, file=file)
+    print('  Общее время: %.4f с' % stats.elapsed(), file=file)
+    print('  Время по фазам (classify включает mimetype):', file=file)
+    for phase in stats.phases:
+        print('    %-10s %10.4f с' % (phase, stats.phase_times[phase]), file=file)
+    if stats.slowest_directories:
+        print('  Самые медленные директории:', file=file)
+        for seconds, path in stats.get_slowest_directories():
+            print('    %10.4f с  %s' % (seconds, path), file=file)
+
+# Функция для построчного вывода записей iter_directory_sizes в формате NDJSON или CSV
+# sections - секции деталей ('type', 'ext', 'mimetype'), которые нужно вывести
+def write_directory_records(records, output_format = 'ndjson', sections = (), file = None):
+    if file is None:
+        file = sys.stdout
+    if output_format == 'csv':
+        writer = csv.writer(file)
+        writer.writerow(['path', 'depth', 'size'] + list(sections))
+    for record in records:
+        if output_format == 'csv':
+            writer.writerow([record['path'], record['depth'], record['size']] + [json.dumps(record['detail'][section]) for section in sections])
         else:
-            print_node(children, ' ' * (level * 3), level + 1, detail, detail_ext, detail_mimetype)
-        #print(' ' * (level * 3) + '-' * (100 - (level * 3)))
-    
+            row = {'path': record['path'], 'depth': record['depth'], 'size': record['size']}
+            for section in sections:
+                row[section] = record['detail'][section]
+            file.write(json.dumps(row) + '\n')
+
+snapshot_magic = b'DSCSNAP1'
+
+# Функция для проверки, что калькулятор содержит directory_sizes в виде словаря "путь -> (размер, глубина)"
+def check_directory_sizes(size_canculator):
+    if isinstance(size_canculator.directory_sizes.get("children"), list):
+        raise ValueError('Снимок сохраняется до build_nested_structure')
+
+# Функция для сохранения результатов калькуляторов (до build_nested_structure) в файл снимка path
+# Файлы с расширением .json сохраняются в JSON, остальные - в двоичном формате: заголовок,
+# столбцы int64 (размеры директорий, смещения и размеры деталей), столбцы int32 (родитель, имя, глубина,
+# категории деталей) и таблицы имён и категорий, разделённых '\0'. Директория хранится как
+# (номер родителя, номер имени), поэтому имена интернируются, а столбцы читаются через mmap без разбора
+def save_snapshot(calculators, path):
+    if path.endswith('.json'):
+        roots = []
+        for size_canculator in calculators:
+            check_directory_sizes(size_canculator)
+            directories = [{'path': directory, 'depth': depth, 'size': size, 'detail': size_canculator.get_directory_sizes_detail(directory)}
+                           for directory, (size, depth) in size_canculator.directory_sizes.items()]
+            roots.append({'path': size_canculator.root_path, 'directories': directories})
+        with open(path, 'w') as snapshot_file:
+            json.dump({'version': 1, 'roots': roots}, snapshot_file)
+        return
+    names = []
+    name_ids = {}
+    categories = []
+    category_ids = {}
+    sizes = array.array('q')
+    detail_offsets = array.array('q', [0])
+    detail_sizes = array.array('q')
+    parents = array.array('i')
+    name_column = array.array('i')
+    depths = array.array('i')
+    detail_categories = array.array('i')
+    for size_canculator in calculators:
+        check_directory_sizes(size_canculator)
+        store = size_canculator.detail_store
+        index = {}
+        for directory, (size, depth) in size_canculator.directory_sizes.items():
+            parent = -1
+            if directory != size_canculator.root_path:
+                parent = index.get(os.path.dirname(directory), -1)
+            if parent < 0:
+                name = directory # Корень хранится с полным путём
+            else:
+                name = os.path.basename(directory)
+            name_id = name_ids.get(name)
+            if name_id is None:
+                name_id = name_ids[name] = len(names)
+                names.append(name)
+            index[directory] = len(sizes)
+            if parent < 0:
+                index[directory.rstrip(os.sep) or directory] = len(sizes)
+            sizes.append(size)
+            parents.append(parent)
+            name_column.append(name_id)
+            depths.append(depth)
+            for category_id, category_size in store.items(store.get_vector(directory)):
+                if category_size:
+                    category = store.categories[category_id]
+                    category_id = category_ids.get(category)
+                    if category_id is None:
+                        category_id = category_ids[category] = len(categories)
+                        categories.append(category)
+                    detail_categories.append(category_id)
+                    detail_sizes.append(category_size)
+            detail_offsets.append(len(detail_sizes))
+    names_blob = '\0'.join(names).encode('utf-8', 'surrogateescape')
+    categories_blob = '\0'.join(section + '\0' + name for section, name in categories).encode('utf-8', 'surrogateescape')
+    # Первое поле заголовка позволяет обнаружить файл, записанный с другим порядком байтов
+    header = array.array('q', [1, len(sizes), len(names), len(categories), len(detail_sizes), len(names_blob), len(categories_blob)])
+    with open(path, 'wb') as snapshot_file:
+        snapshot_file.write(snapshot_magic)
+        for column in (header, sizes, detail_offsets, detail_sizes, parents, name_column, depths, detail_categories):
+            column.tofile(snapshot_file)
+        snapshot_file.write(names_blob)
+        snapshot_file.write(categories_blob)
+
+# Функция для загрузки снимка, возвращает список калькуляторов (по одному на корень) в порядке сохранения
+# с directory_sizes и деталями, как после size_files_in_directory
+def load_snapshot(path):
+    if path.endswith('.json'):
+        with open(path) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+        calculators = []
+        for root in snapshot['roots']:
+            size_canculator = DirectorySizeCalculator()
+            size_canculator.root_path = root['path']
+            for directory in root['directories']:
+                size_canculator.directory_sizes[directory['path']] = (directory['size'], directory['depth'])
+                size_canculator.detail_store.add_detail_sizes(directory['path'], directory['detail'])
+            calculators.append(size_canculator)
+        return calculators
+    with open(path, 'rb') as snapshot_file:
+        with mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ) as snapshot_map:
+            views = [memoryview(snapshot_map)]
+            try:
+                return read_snapshot(views)
+            finally:
+                for view in reversed(views):
+                    view.release()
+
+# Функция для чтения двоичного снимка из memoryview views[0], созданные срезы добавляются в views
+def read_snapshot(views):
+    view = views[0]
+    if bytes(view[:len(snapshot_magic)]) != snapshot_magic:
+        raise ValueError('Файл не является снимком DirectorySizeCalculator')
+    offset = len(snapshot_magic)
+
+    def column(code, count):
+        nonlocal offset
+        size = count * array.array(code).itemsize
+        views.append(view[offset:offset + size])
+        views.append(views[-1].cast(code))
+        offset += size
+        return views[-1]
+
+    byte_order, count, names_count, categories_count, detail_count, names_length, categories_length = column('q', 7)
+    if byte_order != 1:
+        raise ValueError('Снимок записан с другим порядком байтов')
+    sizes = column('q', count)
+    detail_offsets = column('q', count + 1)
+    detail_sizes = column('q', detail_count)
+    parents = column('i', count)
+    name_column = column('i', count)
+    depths = column('i', count)
+    detail_categories = column('i', detail_count)
+    names = bytes(view[offset:offset + names_length]).decode('utf-8', 'surrogateescape').split('\0')
+    offset += names_length
+    categories = bytes(view[offset:offset + categories_length]).decode('utf-8', 'surrogateescape').split('\0')
+    categories = list(zip(categories[0::2], categories[1::2]))
+    calculators = []
+    paths = []
+    owners = [] # Номер директории -> калькулятор её корня
+    for i in range(count):
+        parent = parents[i]
+        if parent < 0:
+            paths.append(names[name_column[i]])
+            size_canculator = DirectorySizeCalculator()
+            size_canculator.root_path = paths[i]
+            # Идентификаторы категорий хранилища совпадают с номерами категорий снимка
+            for section, name in categories:
+                size_canculator.detail_store.category_id(section, name)
+            calculators.append(size_canculator)
+        else:
+            paths.append(os.path.join(paths[parent], names[name_column[i]]))
+            size_canculator = owners[parent]
+        owners.append(size_canculator)
+        size_canculator.directory_sizes[paths[i]] = (sizes[i], depths[i])
+        start, end = detail_offsets[i], detail_offsets[i + 1]
+        if start < end:
+            vector = array.array('q', bytes(16 * (end - start)))
+            vector[0::2] = array.array('q', detail_categories[start:end])
+            vector[1::2] = array.array('q', detail_sizes[start:end])
+            size_canculator.detail_store.vectors[paths[i]] = vector
+    return calculators
+
+# Функция для сравнения двух снимков (списков калькуляторов из load_snapshot) без обращения к файловой системе
+# Возвращает limit наибольших приростов: директорий (рост, старый размер, новый размер, путь),
+# категорий по сумме корней (рост, секция, имя) и категорий в директориях (рост, путь, секция, имя)
+def diff_snapshots(old_calculators, new_calculators, limit = 20):
+    old_sizes = {}
+    new_sizes = {}
+    old_totals = collections.Counter()
+    new_totals = collections.Counter()
+    for calculators, directory_sizes, totals in ((old_calculators, old_sizes, old_totals), (new_calculators, new_sizes, new_totals)):
+        for size_canculator in calculators:
+            check_directory_sizes(size_canculator)
+            for directory, (size, depth) in size_canculator.directory_sizes.items():
+                directory_sizes[directory] = (size, size_canculator)
+            root_detail = size_canculator.get_directory_sizes_detail(size_canculator.root_path)
+            for section, section_sizes in root_detail.items():
+                for name, size in section_sizes.items():
+                    totals[(section, name)] += size
+    directories = []
+    directory_categories = []
+    for directory in new_sizes.keys() | old_sizes.keys():
+        old_size, old_canculator = old_sizes.get(directory, (0, None))
+        new_size, new_canculator = new_sizes.get(directory, (0, None))
+        if new_size > old_size:
+            directories.append((new_size - old_size, old_size, new_size, directory))
+        old_detail = {}
+        if old_canculator is not None:
+            old_detail = old_canculator.get_directory_sizes_detail(directory)
+        if new_canculator is not None:
+            for section, section_sizes in new_canculator.get_directory_sizes_detail(directory).items():
+                old_section_sizes = old_detail.get(section, {})
+                for name, size in section_sizes.items():
+                    growth = size - old_section_sizes.get(name, 0)
+                    if growth > 0:
+                        directory_categories.append((growth, directory, section, name))
+    categories = [(new_totals[category] - old_totals[category], *category) for category in new_totals
+                  if new_totals[category] > old_totals[category]]
+    return {'directories': heapq.nlargest(limit, directories),
+            'categories': heapq.nlargest(limit, categories),
+            'directory_categories': heapq.nlargest(limit, directory_categories)}
+
+# Функция для вывода результата diff_snapshots
+def print_snapshot_diff(diff, file = None):
+    if file is None:
+        file = sys.stdout
+    print('Наибольший рост директорий:', file=file)
+    for growth, old_size, new_size, directory in diff['directories']:
+        print(('+' + human_readable_size(growth)).rjust(12) + '  %s -> %s  %s' % (human_readable_size(old_size), human_readable_size(new_size), directory), file=file)
+    print('', file=file)
+    print('Наибольший рост категорий:', file=file)
+    for growth, section, name in diff['categories']:
+        print(('+' + human_readable_size(growth)).rjust(12) + '  %s:%s' % (section, name), file=file)
+    print('', file=file)
+    print('Наибольший рост категорий в директориях:', file=file)
+    for growth, directory, section, name in diff['directory_categories']:
+        print(('+' + human_readable_size(growth)).rjust(12) + '  %s:%s  %s' % (section, name, directory), file=file)
+
 # Использование класса
 if __name__ == "__main__":
     parser = argparse.ArgumentParser("python " + sys.argv[0], formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("paths", help='Пути к каталогам (если не указаны, путь запрашивается)', nargs='*')
+    parser.add_argument("-md", "--max-depth", help='Максимальная вложенность (если не указана, запрашивается)', type=int, default=None)
     parser.add_argument("-d", "--detail", help='Указывать размер файлов по типу', type=str, choices=["Y", "N"], default="N")  
     parser.add_argument("-de", "--detail-ext", help='Указывать размер файлов по расширению', type=str, choices=["Y", "N"], default="N")
     parser.add_argument("-dm", "--detail-mimetype", help='Указывать размер файлов по mimetype', type=str, choices=["Y", "N"], default="N")
     parser.add_argument("-s", "--sort", help='Сортировка', type=str, choices=["name", "size"], default="name")  
+    parser.add_argument("-w", "--workers", help='Количество потоков для параллельного сканирования', type=int, default=1)
+    parser.add_argument("-p", "--processes", help='Количество процессов для сканирования поддиректорий первого уровня', type=int, default=1)
+    parser.add_argument("-sm", "--size-mode", help='Размер файла (apparent) или занятое место на диске (disk)', type=str, choices=["apparent", "disk"], default="apparent")
+    parser.add_argument("-hl", "--hardlinks", help='Учитывать жёсткие ссылки на один файл только один раз', type=str, choices=["Y", "N"], default="Y")
+    parser.add_argument("-c", "--categories", help='JSON-файл с пользовательскими типами файлов вида {"тип": [".ext", ...]}', type=str, default=None)
+    parser.add_argument("-o", "--output", help='Формат вывода: дерево (tree) или потоковый вывод строк по мере сканирования (ndjson, csv)', type=str, choices=["tree", "ndjson", "csv"], default="tree")
+    parser.add_argument("-mp", "--min-percent", help='Не выводить директории меньше указанного процента от размера родительской', type=float, default=0)
+    parser.add_argument("-ml", "--max-level", help='Не выводить директории глубже указанного уровня', type=int, default=None)
+    parser.add_argument("-t", "--top", help='Вывести N самых больших файлов и директорий вместо дерева', type=int, default=0)
+    parser.add_argument("-tb", "--top-by", help='Дополнительно вывести N самых больших файлов каждого типа или расширения', type=str, choices=["type", "ext"], default=None)
+    parser.add_argument("-C", "--cache", help='Файл кэша SQLite: повторно сканируются только директории с изменившимся mtime', type=str, default=None)
+    parser.add_argument("-e", "--exclude", help='glob-шаблон файлов и директорий, которые не сканируются (можно указать несколько раз, шаблон с "/" сравнивается с полным путём)', type=str, action="append", default=None)
+    parser.add_argument("-in", "--include", help='glob-шаблон файлов, которые учитываются (можно указать несколько раз, директории обходятся все)', type=str, action="append", default=None)
+    parser.add_argument("-x", "--one-file-system", help='Не переходить в директории на других файловых системах', type=str, choices=["Y", "N"], default="N")
+    parser.add_argument("-S", "--save", help='Сохранить результаты сканирования с деталями по категориям в файл снимка (.json - JSON, иначе двоичный формат)', type=str, default=None)
+    parser.add_argument("-L", "--load", help='Вывести дерево из файла снимка вместо сканирования', type=str, default=None)
+    parser.add_argument("-D", "--diff", help='Сравнить два файла снимков и вывести наибольший рост директорий и категорий', type=str, nargs=2, metavar=("OLD", "NEW"), default=None)
+    parser.add_argument("-dl", "--diff-limit", help='Количество строк в каждом разделе сравнения снимков', type=int, default=20)
+    parser.add_argument("-el", "--error-log", help='Файл журнала ошибок, записывается один раз в конце работы (пустая строка - не записывать)', type=str, default="exceptions.log")
+    parser.add_argument("-me", "--max-errors", help='Максимальное количество сохраняемых записей об ошибках (счётчики по errno учитывают все ошибки)', type=int, default=1000)
+    parser.add_argument("-st", "--stats", help='Вывести в stderr статистику сканирования: время по фазам, счётчики и самые медленные директории', type=str, choices=["Y", "N"], default="N")
+    parser.add_argument("-pr", "--progress", help='Выводить в stderr ход сканирования', type=str, choices=["Y", "N"], default="N")
     args = parser.parse_args()
-    size_canculator = DirectorySizeCalculator()
-    input_directory_path = input('Путь к каталогу: ').strip()  # Укажите путь к вашему каталогу
-    input_max_depth = input('Максимальная вложенность: ')
-    if input_directory_path.endswith('/'):
-        input_directory_path = input_directory_path[:-1]
-    size_canculator.size_files_in_directory(input_directory_path, int(input_max_depth))
-    size_canculator.build_nested_structure()
-    if args.sort == 'size':
-        size_canculator.sort_by_size(size_canculator.directory_sizes)
-    else:
-        size_canculator.sort_by_name(size_canculator.directory_sizes)
+    # Сканирование в нескольких процессах поддерживается только для вывода дерева без кэша
+    if args.processes > 1:
+        if args.cache is not None:
+            parser.error('-p/--processes нельзя использовать вместе с -C/--cache')
+        if args.output != 'tree':
+            parser.error('-p/--processes поддерживается только для вывода дерева (-o tree)')
+        if args.top > 0:
+            parser.error('-p/--processes нельзя использовать вместе с -t/--top')
+    # Кэш не хранит отдельные файлы, поэтому поиск самых больших файлов всегда сканирует дерево
+    if args.top > 0 and args.cache is not None:
+        parser.error('-t/--top нельзя использовать вместе с -C/--cache')
+    # Потоковый вывод сканирует дерево в одном потоке без кэша
+    if args.output != 'tree':
+        if args.cache is not None:
+            parser.error('-C/--cache поддерживается только для вывода дерева (-o tree)')
+        if args.workers > 1:
+            parser.error('-w/--workers поддерживается только для вывода дерева (-o tree)')
+    # Снимок сохраняется и загружается только при выводе дерева
+    for option, value in (('-S/--save', args.save), ('-L/--load', args.load)):
+        if value is None:
+            continue
+        if args.output != 'tree':
+            parser.error(option + ' поддерживается только для вывода дерева (-o tree)')
+        if args.top > 0:
+            parser.error(option + ' нельзя использовать вместе с -t/--top')
+    categories = None
+    if args.categories:
+        categories = load_file_categories(args.categories)
+    stats = None
+    if args.stats == 'Y' or args.progress == 'Y':
+        stats = ScanStats()
+        if args.progress == 'Y':
+            stats.progress = print_progress
+    options = {'workers': args.workers, 'size_mode': args.size_mode, 'dedup_hardlinks': args.hardlinks == 'Y',
+               'categories': categories, 'cache': args.cache, 'top': args.top, 'top_by': args.top_by, 'stats': stats,
+               'max_errors': args.max_errors, 'exclude': args.exclude, 'include': args.include,
+               'one_file_system': args.one_file_system == 'Y',
+               # Снимок хранит детали по категориям для -D, поэтому при -S детали собираются всегда
+               'detail': 'Y' in (args.detail, args.detail_ext, args.detail_mimetype) or args.save is not None}
+
+    # Функция для записи журнала ошибок калькуляторов и вывода сообщения о них
+    def report_errors(calculators, file = None, prefix = ''):
+        error_counts = collections.Counter()
+        append = False
+        for size_canculator in calculators:
+            if size_canculator.error_count == 0:
+                continue
+            error_counts.update(size_canculator.get_error_counts())
+            if args.error_log:
+                size_canculator.write_error_log(args.error_log, append)
+                append = True
+        if error_counts:
+            message = prefix + 'Обнаружены ошибки (%s)' % format_error_counts(error_counts)
+            if args.error_log:
+                message += ', посмотрите файл ' + args.error_log
+            print(message, file=file)
+
+    # Функция для вывода итогов статистики в конце работы
+    def finish_stats():
+        if args.progress == 'Y':
+            print_progress(stats)
+            sys.stderr.write('\n')
+        if args.stats == 'Y':
+            print_stats(stats)
+    if args.diff is not None:
+        print_snapshot_diff(diff_snapshots(load_snapshot(args.diff[0]), load_snapshot(args.diff[1]), args.diff_limit))
+        sys.exit()
+    input_directory_paths = args.paths
+    if len(input_directory_paths) == 0 and args.load is None:
+        input_directory_paths = [input('Путь к каталогу: ').strip()]  # Укажите путь к вашему каталогу
+    for i, input_directory_path in enumerate(input_directory_paths):
+        if input_directory_path.endswith('/') and len(input_directory_path) > 1:
+            input_directory_paths[i] = input_directory_path[:-1]
+    if args.top > 0:
+        size_canculator = DirectorySizeCalculator(**options)
+        for input_directory_path in input_directory_paths:
+            size_canculator.find_top(input_directory_path)
+        print_top_items('Самые большие файлы:', size_canculator.get_top_files())
+        print_top_items('Самые большие директории:', size_canculator.get_top_directories())
+        for category, items in size_canculator.get_top_files_by_category().items():
+            print_top_items('Самые большие файлы (%s):' % category, items)
+        report_errors([size_canculator])
+        if stats is not None:
+            finish_stats()
+        sys.exit()
+    input_max_depth = args.max_depth
+    if input_max_depth is None and args.load is None:
+        input_max_depth = int(input('Максимальная вложенность: '))
     if args.detail == 'Y':
         detail = True
     else:
@@ -443,7 +2002,35 @@ if __name__ == "__main__":
         detail_mimetype = True
     else:
         detail_mimetype = False
-    print_node(size_canculator.directory_sizes, '', 0, detail, detail_ext, detail_mimetype)
-    if len(size_canculator.get_errors()) > 0:
-        print('\nОбнаружены ошибки, посмотрите файл exceptions.log')
-    #size_canculator.print_errors()
+    if args.output != 'tree':
+        size_canculator = DirectorySizeCalculator(**options)
+        sections = [section for section, enabled in (('type', detail), ('ext', detail_ext), ('mimetype', detail_mimetype)) if enabled]
+        records = itertools.chain.from_iterable(size_canculator.iter_directory_sizes(input_directory_path, input_max_depth, len(sections) > 0)
+                                                for input_directory_path in input_directory_paths)
+        try:
+            write_directory_records(records, args.output, sections)
+        except BrokenPipeError:
+            # Получатель вывода (например, head) закрыл канал
+            sys.stdout = open(os.devnull, 'w')
+        report_errors([size_canculator], sys.stderr)
+        if stats is not None:
+            finish_stats()
+    else:
+        if args.load is not None:
+            calculators = load_snapshot(args.load)
+        else:
+            calculators = scan_roots(input_directory_paths, input_max_depth, args.processes, **options)
+        if args.save is not None:
+            save_snapshot(calculators, args.save)
+        for size_canculator in calculators:
+            size_canculator.build_nested_structure(detail or detail_ext or detail_mimetype)
+            if args.sort == 'size':
+                size_canculator.sort_by_size(size_canculator.directory_sizes)
+            else:
+                size_canculator.sort_by_name(size_canculator.directory_sizes)
+            with stats.timer('render') if stats is not None else contextlib.nullcontext():
+                render_node(size_canculator.directory_sizes, sys.stdout, detail, detail_ext, detail_mimetype, args.min_percent, args.max_level)
+        report_errors(calculators, prefix = '\n')
+        if stats is not None:
+            finish_stats()
+        #size_canculator.print_errors()
@@ -0,0 +1,215 @@
+import os
+import io
+import sys
+import time
+import json
+import random
+import argparse
+import tempfile
+import tracemalloc
+
+from DirectorySizeCalculator import DirectorySizeCalculator, render_node, file_types
+
+# Формы синтетических деревьев: количество поддиректорий на уровне, глубина, файлов в директории, размер файла
+tree_shapes = {
+    'wide': {'fanout': 200, 'depth': 1, 'files': 20, 'file_size': 4096},
+    'deep': {'fanout': 1, 'depth': 400, 'files': 5, 'file_size': 4096},
+    'tiny': {'fanout': 6, 'depth': 3, 'files': 200, 'file_size': 16},
+    'mixed': {'fanout': 5, 'depth': 3, 'files': 40, 'file_size': 2048},
+    'hardlinks': {'fanout': 5, 'depth': 3, 'files': 40, 'file_size': 2048},
+    'sparse': {'fanout': 4, 'depth': 2, 'files': 10, 'file_size': 64 * 1024 * 1024},
+}
+
+# Функция для создания синтетического дерева в каталоге root
+# scale умножает количество файлов в каждой директории
+# Возвращает количество файлов, количество директорий и список путей файлов
+def generate_tree(root, shape = 'mixed', scale = 1, seed = 0):
+    params = tree_shapes[shape]
+    rng = random.Random(seed)
+    extensions = [extension for file_type, type_extensions in file_types for extension in type_extensions]
+    extensions += ['', '.tmp', '.log', '.bak', '.tar.gz', '.unknown%d' % seed]
+    files = []
+    directories = []
+    pending = [(root, 0)]
+    while pending:
+        directory, depth = pending.pop()
+        os.makedirs(directory, exist_ok=True)
+        directories.append(directory)
+        for i in range(params['files'] * scale):
+            if shape == 'mixed':
+                extension = rng.choice(extensions)
+            else:
+                extension = extensions[i % 8]
+            path = os.path.join(directory, 'file%d%s' % (i, extension))
+            if shape == 'hardlinks' and files and i % 2:
+                # Каждый второй файл - жёсткая ссылка на случайный ранее созданный файл
+                os.link(rng.choice(files), path)
+            elif shape == 'sparse':
+                with open(path, 'wb') as sparse_file:
+                    sparse_file.write(b'x' * 4096)
+                    sparse_file.truncate(params['file_size'])
+            else:
+                with open(path, 'wb') as data_file:
+                    data_file.write(b'x' * rng.randint(0, params['file_size']))
+            files.append(path)
+        if depth < params['depth']:
+            for i in range(params['fanout']):
+                pending.append((os.path.join(directory, 'dir%d' % i), depth + 1))
+    # mtime директорий сдвигается в прошлое, чтобы кэш сканирования им доверял
+    mtime = time.time() - 3600
+    for directory in directories:
+        os.utime(directory, (mtime, mtime))
+    return len(files), len(directories), files
+
+# Калькулятор, подсчитывающий вызовы os.scandir и stat
+class CountingCalculator(DirectorySizeCalculator):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scandir_calls = 0
+        self.stat_calls = 0
+
+    def scandir(self, directory):
+        self.scandir_calls += 1
+        return super().scandir(directory)
+
+    def entry_size(self, entry, hardlinks = None):
+        self.stat_calls += 1
+        return super().entry_size(entry, hardlinks)
+
+    def _scan_directory_cached(self, directory):
+        self.stat_calls += 1
+        return super()._scan_directory_cached(directory)
+
+# Функция для измерения времени выполнения function() и, если memory = True,
+# пикового объёма памяти Python при повторном запуске под tracemalloc
+# prepare() вызывается перед каждым запуском и возвращает аргумент для function
+def measure(prepare, function, memory = True):
+    argument = prepare()
+    start = time.perf_counter()
+    result = function(argument)
+    seconds = time.perf_counter() - start
+    peak_memory = None
+    if memory:
+        argument = prepare()
+        tracemalloc.start()
+        function(argument)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return seconds, peak_memory, result
+
+# Функция для запуска сканирования в режиме mode, возвращает калькулятор
+def scan(root, mode, max_depth, workers, cache_path):
+    if mode == 'serial':
+        size_canculator = CountingCalculator()
+        size_canculator.size_files_in_directory(root, max_depth)
+    elif mode == 'size-only':
+        size_canculator = CountingCalculator(detail = False)
+        size_canculator.size_files_in_directory(root, max_depth)
+    elif mode == 'threads':
+        size_canculator = CountingCalculator(workers = workers)
+        size_canculator.size_files_in_directory(root, max_depth)
+    elif mode == 'processes':
+        size_canculator = DirectorySizeCalculator(processes = workers)
+        size_canculator.size_files_in_directory(root, max_depth)
+    elif mode == 'cache':
+        size_canculator = CountingCalculator(cache = cache_path)
+        size_canculator.size_files_in_directory(root, max_depth)
+    elif mode == 'stream':
+        size_canculator = CountingCalculator()
+        for record in size_canculator.iter_directory_sizes(root, max_depth):
+            pass
+    elif mode == 'top':
+        size_canculator = CountingCalculator(top = 10)
+        size_canculator.find_top(root)
+    return size_canculator
+
+# Функция для запуска всех замеров по дереву root
+def run_benchmark(root, files_count, directories_count, files, modes, max_depth = 10, workers = 4, repeat = 1, memory = True):
+    results = []
+    cache_path = os.path.join(os.path.dirname(root), 'benchmark_cache.sqlite')
+
+    def add_result(mode, phase, seconds, peak_memory, size_canculator = None):
+        result = {'mode': mode, 'phase': phase, 'seconds': seconds, 'files_per_sec': None, 'syscalls_per_file': None, 'peak_memory': peak_memory}
+        if phase == 'scan':
+            result['files_per_sec'] = files_count / seconds if seconds > 0 else None
+            if isinstance(size_canculator, CountingCalculator) and files_count > 0:
+                result['syscalls_per_file'] = (size_canculator.scandir_calls + size_canculator.stat_calls) / files_count
+        results.append(result)
+
+    for mode in modes:
+        label = mode
+        prepare = lambda: root
+        if mode == 'cache':
+            label = 'cache (cold)'
+            def prepare():
+                if os.path.exists(cache_path):
+                    os.remove(cache_path)
+                return root
+        for i in range(repeat):
+            seconds, peak_memory, size_canculator = measure(prepare, lambda root: scan(root, mode, max_depth, workers, cache_path), memory and mode != 'processes')
+            add_result(label, 'scan', seconds, peak_memory, size_canculator)
+        if mode == 'cache':
+            # Повторное сканирование с заполненным кэшем
+            for i in range(repeat):
+                seconds, peak_memory, size_canculator = measure(lambda: root, lambda root: scan(root, mode, max_depth, workers, cache_path), memory)
+                add_result('cache (warm)', 'scan', seconds, peak_memory, size_canculator)
+            os.remove(cache_path)
+
+    # Классификация файлов без системных вызовов
+    def classify(size_canculator):
+        for path in files:
+            size_canculator.add_detail('/', path, 1)
+    seconds, peak_memory, result = measure(DirectorySizeCalculator, classify, memory)
+    add_result('serial', 'classify', seconds, peak_memory)
+
+    def scanned():
+        size_canculator = DirectorySizeCalculator()
+        size_canculator.size_files_in_directory(root, max_depth)
+        return size_canculator
+
+    def built():
+        size_canculator = scanned()
+        size_canculator.build_nested_structure()
+        return size_canculator
+
+    seconds, peak_memory, result = measure(scanned, lambda size_canculator: size_canculator.build_nested_structure(), memory)
+    add_result('serial', 'build', seconds, peak_memory)
+    seconds, peak_memory, result = measure(built, lambda size_canculator: size_canculator.sort_by_size(size_canculator.directory_sizes), memory)
+    add_result('serial', 'sort_by_size', seconds, peak_memory)
+    seconds, peak_memory, result = measure(built, lambda size_canculator: size_canculator.sort_by_name(size_canculator.directory_sizes), memory)
+    add_result('serial', 'sort_by_name', seconds, peak_memory)
+    seconds, peak_memory, result = measure(built, lambda size_canculator: render_node(size_canculator.directory_sizes, io.StringIO(), True, True, True), memory)
+    add_result('serial', 'render', seconds, peak_memory)
+    return results
+
+# Функция для вывода результатов в виде таблицы
+def print_results(report):
+    print('Форма: %s, файлов: %d, директорий: %d' % (report['shape'], report['files'], report['directories']))
+    print('%-14s %-14s %10s %14s %12s %14s' % ('mode', 'phase', 'seconds', 'files/sec', 'calls/file', 'peak memory'))
+    for result in report['results']:
+        files_per_sec = '' if result['files_per_sec'] is None else '%.0f' % result['files_per_sec']
+        syscalls_per_file = '' if result['syscalls_per_file'] is None else '%.2f' % result['syscalls_per_file']
+        peak_memory = '' if result['peak_memory'] is None else '%.1f MB' % (result['peak_memory'] / 1024 / 1024)
+        print('%-14s %-14s %10.4f %14s %12s %14s' % (result['mode'], result['phase'], result['seconds'], files_per_sec, syscalls_per_file, peak_memory))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("python " + sys.argv[0], formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-sh", "--shape", help='Форма синтетического дерева', type=str, choices=list(tree_shapes), default="mixed")
+    parser.add_argument("-sc", "--scale", help='Множитель количества файлов в директории', type=int, default=1)
+    parser.add_argument("-m", "--modes", help='Режимы сканирования через запятую: serial, size-only, threads, processes, cache, stream, top', type=str, default="serial,threads,cache,stream,top")
+    parser.add_argument("-w", "--workers", help='Количество потоков/процессов для режимов threads и processes', type=int, default=4)
+    parser.add_argument("-r", "--repeat", help='Количество повторов сканирования в каждом режиме', type=int, default=1)
+    parser.add_argument("-md", "--max-depth", help='Максимальная вложенность', type=int, default=10)
+    parser.add_argument("-nm", "--no-memory", help='Не измерять пиковую память (tracemalloc)', action="store_true")
+    parser.add_argument("-j", "--json", help='Вывести результаты в формате JSON', action="store_true")
+    parser.add_argument("--seed", help='Начальное значение генератора случайных чисел', type=int, default=0)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory(prefix='dirsize-benchmark-') as temp_directory:
+        root = os.path.join(temp_directory, 'tree')
+        files_count, directories_count, files = generate_tree(root, args.shape, args.scale, args.seed)
+        results = run_benchmark(root, files_count, directories_count, files, args.modes.split(','), args.max_depth, args.workers, args.repeat, not args.no_memory)
+    report = {'shape': args.shape, 'scale': args.scale, 'files': files_count, 'directories': directories_count, 'results': results}
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_results(report)
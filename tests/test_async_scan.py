@@ -0,0 +1,117 @@
+import asyncio
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import DirectorySizeCalculator as dsc
+
+
+# Жёсткие ссылки считаются один раз в пределах каждого запроса AsyncDirectorySizeCalculator
+class AsyncHardlinkTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.tmp.name, 'hl')
+        self.sub = os.path.join(self.root, 'b')
+        os.makedirs(os.path.join(self.root, 'a'))
+        os.makedirs(self.sub)
+        with open(os.path.join(self.root, 'a', 'f.bin'), 'wb') as f:
+            f.write(b'x' * 10000)
+        os.link(os.path.join(self.root, 'a', 'f.bin'), os.path.join(self.sub, 'g.bin'))
+        with open(os.path.join(self.sub, 's.txt'), 'wb') as f:
+            f.write(b'xx')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_overlapping_requests(self):
+        async def scan():
+            async with dsc.AsyncDirectorySizeCalculator(concurrency=4) as calculator:
+                return await asyncio.gather(calculator.size_files_in_directory(self.root),
+                                            calculator.size_files_in_directory(self.sub),
+                                            calculator.size_files_in_directory(self.root))
+        for _ in range(20):
+            root, sub, again = asyncio.run(scan())
+            self.assertEqual(root.directory_sizes[self.root], (10002, 0))
+            self.assertEqual(again.directory_sizes[self.root], (10002, 0))
+            self.assertEqual(sub.directory_sizes[self.sub], (10002, 0))
+            self.assertEqual(sum(root.get_directory_sizes_detail(self.root)['ext'].values()), 10002)
+            self.assertEqual(sum(sub.get_directory_sizes_detail(self.sub)['ext'].values()), 10002)
+
+    def test_matches_serial_scan(self):
+        expected = dsc.DirectorySizeCalculator()
+        expected.size_files_in_directory(self.root)
+
+        async def scan():
+            async with dsc.AsyncDirectorySizeCalculator() as calculator:
+                return await calculator.size_files_in_directory(self.root)
+        result = asyncio.run(scan())
+        self.assertEqual(dict(result.directory_sizes), dict(expected.directory_sizes))
+        for path in expected.directory_sizes:
+            self.assertEqual(result.get_directory_sizes_detail(path), expected.get_directory_sizes_detail(path))
+
+    def test_result_collected_outside_event_loop(self):
+        threads = []
+
+        async def scan():
+            async with dsc.AsyncDirectorySizeCalculator() as calculator:
+                collect_result = calculator._collect_result
+
+                def record_thread(*args):
+                    threads.append(threading.get_ident())
+                    return collect_result(*args)
+                calculator._collect_result = record_thread
+                return await calculator.size_files_in_directory(self.root)
+        self.assertEqual(asyncio.run(scan()).directory_sizes[self.root], (10002, 0))
+        self.assertEqual(len(threads), 1)
+        self.assertNotEqual(threads[0], threading.get_ident())
+
+
+# directory_timeout отсчитывается с начала сканирования директории, а не с постановки в очередь
+class AsyncDirectoryTimeoutTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.roots = []
+        for name in ('x', 'y'):
+            root = os.path.join(self.tmp.name, name)
+            for index in range(3):
+                os.makedirs(os.path.join(root, str(index)))
+            self.roots.append(root)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_queued_directories_do_not_time_out(self):
+        async def scan():
+            async with dsc.AsyncDirectorySizeCalculator(concurrency=1) as calculator:
+                scan_directory = calculator.scanner.scan
+
+                def slow_scan(path, detail = True):
+                    time.sleep(0.1)
+                    return scan_directory(path, detail)
+                calculator.scanner.scan = slow_scan
+                return await asyncio.gather(*(calculator.size_files_in_directory(root, directory_timeout=0.15)
+                                               for root in self.roots))
+        for result in asyncio.run(scan()):
+            self.assertEqual(result.error_count, 0, result.errors)
+            self.assertEqual(len(result.directory_sizes), 4)
+
+    def test_slow_directory_times_out(self):
+        async def scan():
+            async with dsc.AsyncDirectorySizeCalculator() as calculator:
+                scan_directory = calculator.scanner.scan
+
+                def slow_scan(path, detail = True):
+                    if path.endswith('1'):
+                        time.sleep(0.3)
+                    return scan_directory(path, detail)
+                calculator.scanner.scan = slow_scan
+                return await calculator.size_files_in_directory(self.roots[0], directory_timeout=0.1)
+        result = asyncio.run(scan())
+        self.assertEqual(result.error_count, 1)
+        self.assertEqual(result.errors[0].phase, 'timeout')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+import DirectorySizeCalculator as dsc
+
+
+# Жёсткая ссылка учитывается в той же директории, что и при последовательном обходе, в любом режиме сканирования
+class HardlinkOwnershipTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.tmp.name, 'hl')
+        for name in ('a', os.path.join('b', 'c'), 'd'):
+            os.makedirs(os.path.join(self.root, name))
+        self.write(os.path.join('a', 'f.mp4'), 10000)
+        self.link(os.path.join('a', 'f.mp4'), os.path.join('b', 'g.txt'))
+        self.link(os.path.join('a', 'f.mp4'), os.path.join('b', 'c', 'h.bin'))
+        self.link(os.path.join('a', 'f.mp4'), os.path.join('d', 'k.mp4'))
+        self.write(os.path.join('b', 'c', 'x.iso'), 3000)
+        self.link(os.path.join('b', 'c', 'x.iso'), os.path.join('d', 'y.iso'))
+        self.write(os.path.join('b', 's'), 5)
+        self.write(os.path.join('d', 't'), 7)
+        # Кэш доверяет только директориям, изменённым заметно раньше сканирования
+        mtime = os.stat(self.root).st_mtime - 3600
+        for directory, subdirectories, files in os.walk(self.root):
+            os.utime(directory, (mtime, mtime))
+        self.expected = self.scan()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, size):
+        with open(os.path.join(self.root, name), 'wb') as f:
+            f.write(b'x' * size)
+
+    def link(self, source, name):
+        os.link(os.path.join(self.root, source), os.path.join(self.root, name))
+
+    def scan(self, max_depth = 3, **options):
+        calculator = dsc.DirectorySizeCalculator(**options)
+        calculator.size_files_in_directory(self.root, max_depth)
+        return self.result(calculator)
+
+    def result(self, calculator):
+        return {path: (size, calculator.get_directory_sizes_detail(path)) for path, (size, depth) in calculator.directory_sizes.items()}
+
+    def test_serial_counts_each_inode_once(self):
+        self.assertEqual(self.expected[self.root][0], 13012)
+
+    def test_workers(self):
+        self.assertEqual(self.scan(workers=4), self.expected)
+
+    def test_cache(self):
+        cache = os.path.join(self.tmp.name, 'cache.sqlite')
+        self.assertEqual(self.scan(cache=cache), self.expected)
+        self.assertEqual(self.scan(cache=cache), self.expected)
+
+    def test_processes(self):
+        for max_depth in (0, 1, 3):
+            self.assertEqual(self.scan(max_depth, processes=2), self.scan(max_depth))
+        calculator = dsc.DirectorySizeCalculator(processes=2, detail=False)
+        calculator.size_files_in_directory(self.root, 1)
+        self.assertEqual(calculator.directory_sizes[self.root], (13012, 0))
+
+    def test_processes_top(self):
+        expected = dsc.DirectorySizeCalculator(top=3)
+        expected.size_files_in_directory(self.root, 1)
+        calculator = dsc.DirectorySizeCalculator(top=3, processes=2)
+        calculator.size_files_in_directory(self.root, 1)
+        self.assertEqual(calculator.get_top_files(), expected.get_top_files())
+        self.assertEqual(calculator.get_top_directories(), expected.get_top_directories())
+
+    def test_streaming(self):
+        calculator = dsc.DirectorySizeCalculator()
+        records = {record['path']: (record['size'], record['detail']) for record in calculator.iter_directory_sizes(self.root, 3)}
+        self.assertEqual(records, self.expected)
+
+    def test_async(self):
+        async def scan():
+            async with dsc.AsyncDirectorySizeCalculator() as calculator:
+                return await calculator.size_files_in_directory(self.root, 3)
+        self.assertEqual(self.result(asyncio.run(scan())), self.expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
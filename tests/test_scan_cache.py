@@ -0,0 +1,117 @@
+import os
+import tempfile
+import time
+import unittest
+
+import DirectorySizeCalculator as dsc
+
+
+# Кэш сканирования: повторное сканирование по mtime директорий и сброс кэша при смене настроек
+class ScanCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.tmp.name, 'hl')
+        self.cache = os.path.join(self.tmp.name, 'cache.sqlite')
+        os.makedirs(os.path.join(self.root, 'a'))
+        os.makedirs(os.path.join(self.root, 'b'))
+        os.makedirs(os.path.join(self.root, 'c'))
+        self.write(os.path.join('a', 'f.bin'), 10000)
+        os.link(os.path.join(self.root, 'a', 'f.bin'), os.path.join(self.root, 'b', 'g.bin'))
+        self.write(os.path.join('b', 's.txt'), 2)
+        self.write(os.path.join('c', 'v.mp4'), 300)
+        # Кэш доверяет только директориям, изменённым заметно раньше сканирования
+        self.mtime = time.time() - 3600
+        for directory in (self.root, 'a', 'b', 'c'):
+            self.touch(directory)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, size):
+        with open(os.path.join(self.root, name), 'wb') as f:
+            f.write(b'x' * size)
+
+    def touch(self, directory, offset = 0):
+        path = os.path.join(self.root, directory)
+        os.utime(path, (self.mtime + offset, self.mtime + offset))
+
+    def scan(self, **options):
+        calculator = dsc.DirectorySizeCalculator(stats=True, **options)
+        calculator.size_files_in_directory(self.root, 3)
+        return calculator
+
+    def result(self, calculator):
+        return {path: (size, calculator.get_directory_sizes_detail(path)) for path, (size, depth) in calculator.directory_sizes.items()}
+
+    def test_hardlinks_after_rescan(self):
+        self.assertEqual(self.scan(cache=self.cache).directory_sizes[self.root], (10302, 0))
+        # Повторное сканирование только b не должно учитывать ссылку второй раз
+        self.touch('b', 60)
+        calculator = self.scan(cache=self.cache)
+        self.assertGreater(calculator.stats.cache_hits, 0)
+        self.assertEqual(calculator.directory_sizes[self.root], (10302, 0))
+        self.assertEqual(self.result(calculator), self.result(self.scan()))
+
+    def test_unchanged_directories_from_cache(self):
+        expected = self.result(self.scan())
+        self.scan(cache=self.cache)
+        calculator = self.scan(cache=self.cache)
+        self.assertEqual(self.result(calculator), expected)
+        # Директории с жёсткими ссылками не кэшируются, остальные берутся из кэша
+        self.assertEqual(calculator.stats.cache_hits, 2)
+        self.assertEqual(calculator.stats.files, 3)
+        # Изменение размера файла без изменения mtime директории видно только без кэша
+        self.write(os.path.join('c', 'v.mp4'), 500)
+        self.touch('c')
+        self.assertEqual(self.scan(cache=self.cache).directory_sizes[os.path.join(self.root, 'c')], (300, 1))
+
+    def test_changed_mtime_invalidates_directory(self):
+        self.scan(cache=self.cache)
+        self.write(os.path.join('c', 'w.txt'), 40)
+        self.touch('c', 60)
+        calculator = self.scan(cache=self.cache)
+        self.assertEqual(calculator.directory_sizes[os.path.join(self.root, 'c')], (340, 1))
+        self.assertEqual(calculator.directory_sizes[self.root], (10342, 0))
+        self.assertEqual(calculator.get_directory_sizes_detail(os.path.join(self.root, 'c'))['ext'], {'.mp4': 300, '.txt': 40})
+
+    def test_settings_change_discards_cache(self):
+        self.scan(cache=self.cache)
+        for options in ({'size_mode': 'disk'}, {'exclude': ['*.mp4']}, {'dedup_hardlinks': False},
+                        {'categories': {'clip': ['.mp4']}}):
+            calculator = self.scan(cache=self.cache, **options)
+            self.assertEqual(calculator.stats.cache_hits, 0, options)
+            self.assertEqual(self.result(calculator), self.result(self.scan(**options)), options)
+
+
+# Снимок в двоичном формате и в JSON загружается с теми же размерами и деталями, что были сохранены
+class SnapshotRoundTripTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.roots = [os.path.join(self.tmp.name, 'first'), os.path.join(self.tmp.name, 'second')]
+        for name, size in ((os.path.join('first', 'видео', 'a.mp4'), 1000), (os.path.join('first', 'видео', 'b.txt'), 30),
+                           (os.path.join('first', 'docs', 'c.pdf'), 200), (os.path.join('first', 'd'), 5),
+                           (os.path.join('second', 'docs', 'e.pdf'), 70)):
+            path = os.path.join(self.tmp.name, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(b'x' * size)
+        self.calculators = dsc.scan_roots(self.roots, 2, detail=True)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def result(self, calculators):
+        return [(calculator.root_path, list(calculator.directory_sizes.items()),
+                 {path: calculator.get_directory_sizes_detail(path) for path in calculator.directory_sizes})
+                for calculator in calculators]
+
+    def test_round_trip(self):
+        expected = self.result(self.calculators)
+        for name in ('snapshot.bin', 'snapshot.json'):
+            path = os.path.join(self.tmp.name, name)
+            dsc.save_snapshot(self.calculators, path)
+            self.assertEqual(self.result(dsc.load_snapshot(path)), expected, name)
+
+
+if __name__ == '__main__':
+    unittest.main()